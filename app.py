@@ -3,24 +3,32 @@ import os
 import io
 import tempfile
 import base64
-import zipfile
+import hashlib
+import functools
+import threading
+import httpx
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 from dotenv import load_dotenv
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from result_cache import ResultCache, result_key
+from zip_export import ZipExport
+from blob_store import BlobStore
+from output_encoder import PRESETS, draft, encode_bytes, encode_image, fit_size, preset_with
+import chroma_key
+from job_queue import JobQueue
+from governor import RequestGovernor
+from stub_backend import StubBackend
+import metrics
 
 # Load environment variables
 load_dotenv()
 
-# Page configuration
-st.set_page_config(
-    page_title="Nano Banana Party Photo Editor",
-    page_icon="🍌",
-    layout="wide"
-)
-
 # Custom CSS for birthday party theme
-st.markdown("""
+PAGE_CSS = """
 <style>
     .main-header {
         text-align: center;
@@ -147,7 +155,16 @@ st.markdown("""
         }
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+def setup_page():
+    """Page configuration and theme CSS, done by main() so importing the module makes no Streamlit calls"""
+    st.set_page_config(
+        page_title="Nano Banana Party Photo Editor",
+        page_icon="🍌",
+        layout="wide"
+    )
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
 # Pre-defined prompts for birthday party
 PREDEFINED_PROMPTS = {
@@ -157,132 +174,1122 @@ PREDEFINED_PROMPTS = {
     "shroomy": "🍄 Shroomy - Make the people appear in a colorful shroomy world. Change the outfits to alice in wonderland mode.",
 }
 
-def process_image_for_high_quality(image):
-    """Process image for maximum quality and API compatibility"""
+# Largest edge (in pixels) kept for archival copies of photos (generated results)
+MAX_IMAGE_EDGE = int(os.environ.get("PARTY_ARCHIVE_MAX_EDGE", "4096"))
+
+# Uploads above this many pixels are rejected before any pixel data is decoded
+MAX_INPUT_PIXELS = int(float(os.environ.get("PARTY_MAX_INPUT_MEGAPIXELS", "100")) * 1_000_000)
+
+# EXIF orientation tag values and the transpose that puts the photo upright
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Maximum number of prompts sent to the model at the same time (1 = one after another)
+MAX_PARALLEL_REQUESTS = max(1, int(os.environ.get("PARTY_MAX_PARALLEL_REQUESTS", "4")))
+
+# Largest number of variants a guest can ask for per theme; they are requested as
+# candidates of one model call (falling back to single calls if fewer come back)
+MAX_VARIANTS = max(1, int(os.environ.get("PARTY_MAX_VARIANTS", "4")))
+
+# Keep-alive HTTP connections shared by all sessions talking to Gemini
+GEMINI_POOL_SIZE = max(1, int(os.environ.get("PARTY_GEMINI_POOL_SIZE", str(MAX_PARALLEL_REQUESTS * 2))))
+
+GEMINI_MODEL = "gemini-2.5-flash-image-preview"
+
+# "gemini" calls the real API (optionally through PARTY_GEMINI_BASE_URL, e.g. the
+# local HTTP stub); "stub" uses the in-process offline stand-in from stub_backend
+BACKEND = os.environ.get("PARTY_BACKEND", "gemini").lower()
+GEMINI_BASE_URL = os.environ.get("PARTY_GEMINI_BASE_URL") or None
+
+# Process-wide request governor: requests per minute across all guests (0 for no
+# limit), retries for quota/5xx/timeout errors, and a per-request timeout. The
+# number of requests in flight adapts between 1 and PARTY_GEMINI_POOL_SIZE.
+REQUESTS_PER_MINUTE = float(os.environ.get("PARTY_REQUESTS_PER_MINUTE", "60"))
+MAX_RETRIES = int(os.environ.get("PARTY_MAX_RETRIES", "4"))
+REQUEST_TIMEOUT_S = float(os.environ.get("PARTY_REQUEST_TIMEOUT_S", "120"))
+
+# Cache of model results keyed by (source photo, prompt, model); an empty
+# PARTY_CACHE_DIR keeps the cache in memory only
+RESULT_CACHE_DIR = os.environ.get("PARTY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nano_banana_cache"))
+RESULT_CACHE_MEMORY_MB = int(os.environ.get("PARTY_CACHE_MEMORY_MB", "128"))
+RESULT_CACHE_DISK_MB = int(os.environ.get("PARTY_CACHE_DISK_MB", "512"))
+RESULT_CACHE_MAX_AGE_HOURS = float(os.environ.get("PARTY_CACHE_MAX_AGE_HOURS", "24"))
+
+# Processed uploads kept across reruns (and shared between sessions), in MB of pixels
+UPLOAD_CACHE_MB = int(os.environ.get("PARTY_UPLOAD_CACHE_MB", "256"))
+
+# ZIP exports stay in memory up to this size, then spill to a temp file
+ZIP_SPOOL_MB = int(os.environ.get("PARTY_ZIP_SPOOL_MB", "32"))
+
+# Sessions keep only blob ids; the encoded photo bytes live in one process-wide
+# store that keeps PARTY_BLOB_MEMORY_MB in RAM and spills the rest to temp files
+# (in PARTY_BLOB_DIR). Past a session's or the process's quota the least recently
+# used photos are evicted. A session's photos are dropped when Streamlit discards
+# the session, or after PARTY_SESSION_IDLE_HOURS without activity.
+BLOB_MEMORY_MB = int(os.environ.get("PARTY_BLOB_MEMORY_MB", "256"))
+BLOB_SESSION_MB = int(os.environ.get("PARTY_BLOB_SESSION_MB", "128"))
+BLOB_TOTAL_MB = int(os.environ.get("PARTY_BLOB_TOTAL_MB", "2048"))
+BLOB_DIR = os.environ.get("PARTY_BLOB_DIR") or None
+SESSION_IDLE_HOURS = float(os.environ.get("PARTY_SESSION_IDLE_HOURS", "2"))
+
+# Uploads are decoded straight down to PARTY_SOURCE_MAX_EDGE, the largest edge sent
+# to the model (kept separate from PARTY_ARCHIVE_MAX_EDGE for generated photos).
+# The source photo is encoded once per batch and the same request part is reused
+# for every prompt. PARTY_SOURCE_TRANSPORT=file uploads it once through the Files
+# API instead of sending the bytes inline with each prompt.
+SOURCE_FORMAT = os.environ.get("PARTY_SOURCE_FORMAT", "JPEG").upper()
+SOURCE_QUALITY = int(os.environ.get("PARTY_SOURCE_QUALITY", "95"))
+SOURCE_MAX_EDGE = int(os.environ.get("PARTY_SOURCE_MAX_EDGE", "2048"))
+SOURCE_TRANSPORT = os.environ.get("PARTY_SOURCE_TRANSPORT", "inline").lower()
+
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+FILE_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+
+# Keep the exact bytes the model returned (no decode/re-encode) whenever they are
+# already a browser-friendly format within the size limit
+OUTPUT_PASSTHROUGH = os.environ.get("PARTY_OUTPUT_PASSTHROUGH", "1") != "0"
+
+# Encoding of the photo downloads and ZIP export (see output_encoder.PRESETS):
+# PARTY_OUTPUT_PRESET is the default that guests can change in the results
+# section, PARTY_OUTPUT_QUALITY and PARTY_OUTPUT_SUBSAMPLING (4:4:4, 4:2:2,
+# 4:2:0) override the presets' settings. Photos are re-encoded once per preset
+# (the result is kept with the session entry), PARTY_ENCODE_WORKERS at a time.
+# The older PARTY_DOWNLOAD_FORMAT=JPEG/PNG/WEBP still picks a matching preset.
+LEGACY_DOWNLOAD_PRESETS = {"ORIGINAL": "original", "JPEG": "archive", "PNG": "png", "WEBP": "webp"}
+DEFAULT_OUTPUT_PRESET = os.environ.get("PARTY_OUTPUT_PRESET") or LEGACY_DOWNLOAD_PRESETS.get(
+    os.environ.get("PARTY_DOWNLOAD_FORMAT", "original").upper(), "original")
+if DEFAULT_OUTPUT_PRESET not in PRESETS:
+    DEFAULT_OUTPUT_PRESET = "original"
+OUTPUT_PRESETS = {
+    name: preset_with(
+        preset,
+        quality=int(os.environ["PARTY_OUTPUT_QUALITY"]) if os.environ.get("PARTY_OUTPUT_QUALITY") else None,
+        subsampling=os.environ.get("PARTY_OUTPUT_SUBSAMPLING"),
+    )
+    for name, preset in PRESETS.items()
+}
+ENCODE_WORKERS = max(1, int(os.environ.get("PARTY_ENCODE_WORKERS", str(min(8, os.cpu_count() or 1)))))
+
+# Generation runs as jobs in a queue shared by every app process on this host
+# (in PARTY_JOB_DIR), so it survives reruns and dropped connections. Each process
+# runs PARTY_JOB_WORKERS worker threads (0 leaves the work to worker.py
+# processes), by default as many as the governor may keep requests in flight
+# (PARTY_GEMINI_POOL_SIZE) so its adaptive concurrency has room to grow; a task
+# whose worker disappears is retried after PARTY_JOB_LEASE_S.
+# Pages with a running job poll it every PARTY_JOB_POLL_S seconds.
+JOB_DIR = os.environ.get("PARTY_JOB_DIR", os.path.join(tempfile.gettempdir(), "nano_banana_jobs"))
+JOB_WORKERS = max(0, int(os.environ.get("PARTY_JOB_WORKERS", str(GEMINI_POOL_SIZE))))
+JOB_LEASE_S = float(os.environ.get("PARTY_JOB_LEASE_S", "600"))
+JOB_POLL_S = float(os.environ.get("PARTY_JOB_POLL_S", "1.0"))
+
+# Photos are shown from copies resized once per photo for their slot instead of
+# the full-resolution bytes, which are only used for downloads. JPEG or PNG:
+# st.image re-encodes any other format on every rerun
+DISPLAY_FORMAT = os.environ.get("PARTY_DISPLAY_FORMAT", "JPEG").upper()
+DISPLAY_QUALITY = int(os.environ.get("PARTY_DISPLAY_QUALITY", "82"))
+PREVIEW_WIDTH = 400
+GALLERY_WIDTH = 500
+
+# The uploaded photo is chroma-keyed locally (at preview size) to score how
+# cleanly its green screen comes off before any model call is made
+CHROMA_PREVIEW = os.environ.get("PARTY_CHROMA_PREVIEW", "1") != "0"
+
+# Source photo ready to be sent to the model: the request part plus a digest of
+# the encoded bytes (used as the result cache key)
+PreparedSource = namedtuple("PreparedSource", ["part", "digest", "mime_type", "size"])
+
+def notify_streamlit(level, message):
+    """Show a status message in the Streamlit page (level is st.error, st.info, ...)"""
+    getattr(st, level)(message)
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def get_gemini_client(api_key, pool_size=GEMINI_POOL_SIZE):
+    """One Gemini client per process, reusing pooled keep-alive connections.
+    
+    The API key is part of the cache key, so changing it builds a fresh client
+    and evicts the old one (its connections close once in-flight calls finish).
+    """
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=60,
+    )
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            base_url=GEMINI_BASE_URL,
+            client_args={"limits": limits},
+            async_client_args={"limits": limits},
+        ),
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_stub_backend():
+    """Offline stand-in for the Gemini client (PARTY_BACKEND=stub)"""
+    return StubBackend.from_env()
+
+def get_generation_client():
+    """Client used for generation: the shared Gemini client or the offline stub"""
+    if BACKEND == "stub":
+        return get_stub_backend()
+    return get_gemini_client(os.environ.get("GEMINI_API_KEY"))
+
+@st.cache_resource(show_spinner=False)
+def get_request_governor():
+    """Rate, concurrency and retry governor shared by every session in this process"""
+    return RequestGovernor(
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        max_concurrency=GEMINI_POOL_SIZE,
+        max_retries=MAX_RETRIES,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    """Result cache shared by every session in this process"""
+    return ResultCache(
+        RESULT_CACHE_DIR,
+        memory_bytes=RESULT_CACHE_MEMORY_MB * 1024 * 1024,
+        disk_bytes=RESULT_CACHE_DISK_MB * 1024 * 1024,
+        max_age_seconds=RESULT_CACHE_MAX_AGE_HOURS * 3600,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_upload_cache():
+    """Processed source photos by content hash, plus uploader file id -> hash (bounded LRU)"""
+    return {"lock": threading.Lock(), "images": OrderedDict(), "file_ids": OrderedDict(), "bytes": 0}
+
+@st.cache_resource(show_spinner=False)
+def get_blob_store():
+    """Encoded photo bytes of every session in this process (bounded, spills to disk)"""
+    return BlobStore(
+        memory_bytes=BLOB_MEMORY_MB * 1024 * 1024,
+        session_quota=BLOB_SESSION_MB * 1024 * 1024,
+        global_quota=BLOB_TOTAL_MB * 1024 * 1024,
+        spill_dir=BLOB_DIR,
+        idle_ttl_seconds=SESSION_IDLE_HOURS * 3600,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_encode_pool():
+    """Threads encoding download payloads for every session (Pillow encodes without the GIL)"""
+    return ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="party_encode")
+
+def current_session_id():
+    """Id of the browser session running this script thread, or None outside Streamlit"""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+def session_tagged(render):
+    """Tag the measurements of a fragment with the browser session
+    
+    A fragment rerun runs only the fragment, never main(), so the tags main()
+    sets on the script thread are not there; each fragment body sets its own.
+    """
+    @functools.wraps(render)
+    def tagged(*args, **kwargs):
+        with metrics.tags(session=current_session_id()):
+            return render(*args, **kwargs)
+    return tagged
+
+def get_session_blobs():
+    """This browser session's handle on the blob store
+    
+    The handle lives in the session state, so when Streamlit discards the session
+    the handle is garbage collected and the session's photos are dropped with it.
+    """
+    blobs = st.session_state.get("blob_session")
+    if blobs is None:
+        blobs = get_blob_store().open_session(current_session_id() or "local")
+        st.session_state.blob_session = blobs
+    return blobs
+
+def read_blob(entry):
+    """Bytes of a photo (or download payload): inline "data", or its "blob" in the blob store
+    
+    Returns None when the blob has been evicted.
+    """
+    if "data" in entry:
+        return entry["data"]
+    return get_blob_store().get(entry["blob"])
+
+def keep_with(entry, data):
+    """Store bytes derived from a photo entry the same way as the entry's own bytes
+    
+    Returns {"data": bytes} for inline entries, or {"blob": id} in the entry's
+    blob store session.
+    """
+    if "blob" not in entry:
+        return {"data": data}
+    store = get_blob_store()
+    return {"blob": store.put(store.session_of(entry["blob"]), data)}
+
+def store_photo(photo, blobs):
+    """Move a generated photo's bytes into the session blob store (in place)"""
+    if "data" in photo:
+        photo["blob"] = blobs.put(photo.pop("data"))
+    return photo
+
+def release_photos(photos):
+    """Delete gallery photos (and their download and display copies) from the blob store"""
+    invalidate_download_payloads(photos)
+    store = get_blob_store()
+    for photo in photos:
+        for image in photo.pop("display", {}).values():
+            if "blob" in image:
+                store.delete(image["blob"])
+        if "blob" in photo:
+            store.delete(photo["blob"])
+
+@st.cache_resource(show_spinner=False)
+def get_job_queue():
+    """Job queue shared by every session (and every app process using PARTY_JOB_DIR)"""
+    return JobQueue(JOB_DIR, lease_seconds=JOB_LEASE_S, max_age_seconds=RESULT_CACHE_MAX_AGE_HOURS * 3600)
+
+@st.cache_resource(show_spinner=False)
+def get_job_workers():
+    """This process's job worker threads, started on first use"""
+    return start_job_workers(get_job_queue(), JOB_WORKERS)
+
+def start_job_workers(queue, count, client=None, cache=None, governor=None):
+    """Start worker threads running queued prompts with generate_single_photo
+    
+    The client, cache and governor are resolved here, in the calling thread,
+    because worker threads have no Streamlit context.
+    """
+    client = client or get_generation_client()
+    cache = cache or get_result_cache()
+    governor = governor or get_request_governor()
+    # Each source photo is prepared (and uploaded, with PARTY_SOURCE_TRANSPORT=file)
+    # once per process, not once per prompt
+    sources = OrderedDict()
+    lock = threading.Lock()
+    
+    def run_task(task):
+        messages = []
+        notify = lambda level, message: messages.append((level, message))
+        # Tagged with the session that submitted the job, like its page's own stages
+        with metrics.tags(session=task["session"], job=task["job_id"][:12], prompt=task["prompt_name"]):
+            with lock:
+                source = sources.get(task["source_digest"])
+            if source is None:
+                with metrics.timer("request_serialization"):
+                    source = prepare_source_image((queue.read_source(task), task["source_mime"]), client=client, notify=notify)
+                with lock:
+                    sources[task["source_digest"]] = source
+                    while len(sources) > 16:
+                        sources.popitem(last=False)
+            photos = generate_single_photo(
+                source,
+                task["prompt_name"],
+                task["prompt_description"],
+                notify=notify,
+                client=client,
+                cache=cache,
+                governor=governor,
+                variants=task["variants"],
+            )
+        return photos, messages
+    
+    return queue.start_workers(run_task, count)
+
+def load_source_photo(uploaded_file, notify=notify_streamlit):
+    """Processed photo for a file uploader / camera file, reused across Streamlit reruns
+    
+    Looks the file up by uploader file id first (no hashing at all), then by a hash
+    of its content, and only runs process_image_for_high_quality on a miss.
+    """
+    cache = get_upload_cache()
+    file_id = getattr(uploaded_file, "file_id", None)
+    
+    with cache["lock"]:
+        digest = cache["file_ids"].get(file_id) if file_id is not None else None
+    if digest is None:
+        digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    
+    with cache["lock"]:
+        image = cache["images"].get(digest)
+        if image is not None:
+            cache["images"].move_to_end(digest)
+    
+    if image is None:
+        # Timed only here, on a miss: cache hits are not decodes
+        with metrics.timer("upload_decode"):
+            opened = Image.open(uploaded_file)
+            with metrics.timer("process_image"):
+                image = process_image_for_high_quality(opened, notify, max_edge=SOURCE_MAX_EDGE)
+        if image is None:
+            return None
+        with cache["lock"]:
+            if digest not in cache["images"]:
+                cache["images"][digest] = image
+                cache["bytes"] += image.width * image.height * len(image.getbands())
+            # Evict least recently used photos (always keeping the newest one)
+            while cache["bytes"] > UPLOAD_CACHE_MB * 1024 * 1024 and len(cache["images"]) > 1:
+                _, evicted = cache["images"].popitem(last=False)
+                cache["bytes"] -= evicted.width * evicted.height * len(evicted.getbands())
+    
+    if file_id is not None:
+        with cache["lock"]:
+            cache["file_ids"][file_id] = digest
+            cache["file_ids"].move_to_end(file_id)
+            while len(cache["file_ids"]) > 1000:
+                cache["file_ids"].popitem(last=False)
+    
+    return image
+
+def process_image_for_high_quality(image, notify=notify_streamlit, max_edge=None):
+    """Process image for maximum quality and API compatibility
+    
+    Expects a freshly opened (not yet loaded) image so large JPEGs can be decoded
+    at reduced scale. The result is upright (EXIF orientation applied), RGB and
+    at most max_edge pixels on its longest side (MAX_IMAGE_EDGE by default; a
+    JPEG decoded at reduced scale may end up to 10% smaller). The upright size
+    of the photo before any downscaling is kept in its info["original_size"].
+    """
+    if max_edge is None:
+        max_edge = MAX_IMAGE_EDGE
     try:
+        # Refuse decompression bombs before any pixels are decoded
+        if image.width * image.height > MAX_INPUT_PIXELS:
+            notify("error", f"❌ Photo is too large ({image.width}x{image.height} pixels)")
+            return None
+        
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        original_size = image.size[::-1] if orientation in (5, 6, 7, 8) else image.size
+        
+        # Let the JPEG decoder downscale by 1/2, 1/4 or 1/8 while decoding
+        if max(image.size) > max_edge:
+            draft(image, *fit_size(image.size, max_edge))
+        
+        # Palette and unusual modes cannot be resampled smoothly
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        elif image.mode not in ('RGB', 'RGBA', 'LA', 'L'):
+            image = image.convert('RGB')
+        
+        # Keep original size for maximum quality, only resize if extremely large.
+        # reducing_gap makes Pillow apply Image.reduce (a fast box filter) by an
+        # integer factor first, so LANCZOS only runs on the last 2x
+        if max(image.size) > max_edge:
+            ratio = max_edge / max(image.size)
+            new_size = (max(1, int(image.width * ratio)), max(1, int(image.height * ratio)))
+            image = image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        
+        # Rotate phone photos upright (done after downscaling, on fewer pixels)
+        if orientation in EXIF_TRANSPOSE:
+            image = image.transpose(EXIF_TRANSPOSE[orientation])
+        
         # Convert to RGB if necessary (important for JPEG output)
-        if image.mode in ('RGBA', 'LA', 'P'):
+        if image.mode in ('RGBA', 'LA'):
             # Create a white background for transparent images
             background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
+            background.paste(image, mask=image.split()[-1])
             image = background
         elif image.mode != 'RGB':
             image = image.convert('RGB')
         
-        # Keep original size for maximum quality, only resize if extremely large
-        max_size = 4096  # Increased for higher quality
-        if max(image.size) > max_size:
-            ratio = max_size / max(image.size)
-            new_size = (int(image.width * ratio), int(image.height * ratio))
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-        
+        image.info["original_size"] = original_size
         return image
     except Exception as e:
-        st.error(f"❌ Error processing image: {str(e)}")
+        notify("error", f"❌ Error processing image: {str(e)}")
         return None
 
-def generate_single_photo(uploaded_image, prompt_name, prompt_description):
-    """Generate a single photo for a specific prompt"""
-    try:
-        client = genai.Client(
-            api_key=os.environ.get("GEMINI_API_KEY"),
-        )
+def encode_generated_photo(data, mime_type, notify=notify_streamlit):
+    """Return (bytes, mime_type) for a model output, keeping the original encoding when possible"""
+    if OUTPUT_PASSTHROUGH:
+        # Image.open only reads the header here; pixels are not decoded
+        with Image.open(io.BytesIO(data)) as probe:
+            if probe.format in IMAGE_MIME_TYPES and max(probe.size) <= MAX_IMAGE_EDGE:
+                return data, IMAGE_MIME_TYPES[probe.format]
+    
+    # Decode only when a resize or format conversion is really needed
+    with metrics.timer("process_image"):
+        image = process_image_for_high_quality(Image.open(io.BytesIO(data)), notify)
+    if image is None:
+        return None, None
+    return encode_image(image, OUTPUT_PRESETS["archive"])
+
+def get_download_payload(photo, preset_name=None):
+    """Download bytes, MIME type and file name for a gallery photo (see get_download_payloads)"""
+    return get_download_payloads([photo], preset_name)[0]
+
+def get_download_payloads(photos, preset_name=None):
+    """Download payloads for gallery photos in an output preset, each encoded at most once
+    
+    Payloads are memoized on the session entries under "download" and rebuilt only
+    when the preset changes or invalidate_download_payloads is called. Missing ones
+    are encoded together on the shared encode pool. Photos kept in the blob store
+    keep their converted payload there too. The payload of a photo whose bytes
+    have been evicted is None.
+    """
+    preset = OUTPUT_PRESETS[preset_name or DEFAULT_OUTPUT_PRESET]
+    payloads, pending = [], []
+    for photo in photos:
+        payload = photo.get("download")
+        if payload is not None and payload["preset"] == preset.name:
+            data = read_blob(payload)
+            payloads.append({**payload, "data": data} if data is not None else None)
+            continue
+        invalidate_download_payloads([photo])
+        data = read_blob(photo)
+        payloads.append(None)
+        if data is None:
+            continue
+        converted = preset.format is not None
+        if converted:
+            pending.append((len(payloads) - 1, photo, data))
+        else:
+            payloads[-1] = remember_download_payload(photo, preset, data, photo["mime_type"], converted)
+    
+    if pending:
+        # Blob store writes stay in this thread; the pool threads only encode
+        pool = get_encode_pool()
+        with metrics.timer("gallery_encode"):
+            futures = [pool.submit(encode_bytes, data, photo["mime_type"], preset) for _, photo, data in pending]
+            for (index, photo, _), future in zip(pending, futures):
+                data, mime_type = future.result()
+                payloads[index] = remember_download_payload(photo, preset, data, mime_type, True)
+    return payloads
+
+def remember_download_payload(photo, preset, data, mime_type, converted):
+    """Memoize a photo's download payload on its session entry and return it with its bytes"""
+    file_name = os.path.splitext(photo["file_name"])[0] + FILE_EXTENSIONS[mime_type]
+    payload = {"preset": preset.name, "mime_type": mime_type, "file_name": file_name}
+    if converted or "blob" not in photo:
+        payload.update(keep_with(photo, data))
+    else:
+        payload["blob"] = photo["blob"]
+    photo["download"] = payload
+    return {**payload, "data": data}
+
+def make_display_image(source, width):
+    """(bytes, mime_type) copy of a photo for a slot width pixels wide
+    
+    source is encoded bytes or a PIL image; copies are never upscaled.
+    """
+    image_format = DISPLAY_FORMAT if DISPLAY_FORMAT in ("JPEG", "PNG") else "JPEG"
+    if isinstance(source, bytes):
+        image = Image.open(io.BytesIO(source))
+        # Let the JPEG decoder downscale while decoding
+        if image.width > width:
+            draft(image, width, max(1, image.height * width // image.width))
+    else:
+        image = source
+    if image.mode not in ("RGB", "RGBA") or (image_format == "JPEG" and image.mode != "RGB"):
+        image = image.convert("RGB")
+    if image.width > width:
+        image = image.resize((width, max(1, image.height * width // image.width)), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    buf = io.BytesIO()
+    image.save(buf, format=image_format, quality=DISPLAY_QUALITY)
+    return buf.getvalue(), IMAGE_MIME_TYPES[image_format]
+
+def get_display_image(entry, width, source=None, view=None):
+    """Pre-sized copy of a photo entry for a width-pixel slot, made once per entry and width
+    
+    The copy is memoized on the entry under "display", next to the original (in
+    the blob store when the entry's bytes are there). source may be passed to
+    resize from an already decoded image (or a function returning one) instead
+    of the entry's bytes; it is required for a named view of the photo (e.g.
+    "keyed"), which is memoized separately. Returns (bytes, mime_type), or None
+    if the photo was evicted.
+    """
+    display = entry.setdefault("display", {})
+    slot = width if view is None else (view, width)
+    stored = display.get(slot)
+    if stored is not None:
+        data = read_blob(stored)
+        if data is not None:
+            return data, stored["mime_type"]
+    
+    if source is None:
+        source = read_blob(entry)
+        if source is None:
+            return None
+    elif callable(source):
+        source = source()
+    with metrics.timer("display_encode"):
+        data, mime_type = make_display_image(source, width)
+    display[slot] = {"mime_type": mime_type, **keep_with(entry, data)}
+    return data, mime_type
+
+def show_display_image(image, width, caption):
+    """Show a pre-sized copy of a photo (from get_display_image) in its slot
+    
+    st.image sends JPEG and PNG bytes that fit their width as they are, so the
+    copy is not decoded or re-encoded again on reruns.
+    """
+    data, mime_type = image
+    st.image(data, caption=caption, width=width, output_format="PNG" if mime_type == "image/png" else "JPEG")
+
+def invalidate_download_payloads(photos):
+    """Forget memoized download payloads so they are rebuilt from the stored photo bytes"""
+    for photo in photos:
+        payload = photo.pop("download", None)
+        if payload is not None and "blob" in payload and payload["blob"] != photo.get("blob"):
+            get_blob_store().delete(payload["blob"])
 
-        model = "gemini-2.5-flash-image-preview"
+def add_photos_to_export(export, photos, preset_name=None):
+    """Append gallery photos' download payloads to a ZIP export (evicted ones are skipped)"""
+    for payload in get_download_payloads(photos, preset_name):
+        if payload is not None:
+            add_payload_to_export(export, payload)
+
+def add_payload_to_export(export, payload):
+    """Append one download payload to a ZIP export"""
+    clean_filename = payload["file_name"].replace(" ", "_").replace(":", "").replace("🎨", "").replace("📥", "")
+    with metrics.timer("zip_encode"):
+        export.add(clean_filename, payload["data"])
+
+def build_zip_export(photos, preset_name=None):
+    """Build a finished ZIP export for a whole gallery in one go"""
+    export = ZipExport(spool_bytes=ZIP_SPOOL_MB * 1024 * 1024)
+    add_photos_to_export(export, photos, preset_name)
+    return export.finish()
+
+def encode_source_image(image):
+    """Return (bytes, mime_type) of the source photo as it is sent to the model"""
+    image_format = SOURCE_FORMAT if SOURCE_FORMAT in IMAGE_MIME_TYPES else "JPEG"
+    
+    if max(image.size) > SOURCE_MAX_EDGE:
+        image = image.copy()
+        image.thumbnail((SOURCE_MAX_EDGE, SOURCE_MAX_EDGE), Image.Resampling.LANCZOS)
+    
+    buf = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buf, format=image_format)
+    else:
+        image.save(buf, format=image_format, quality=SOURCE_QUALITY)
+    return buf.getvalue(), IMAGE_MIME_TYPES[image_format]
+
+def prepare_source_image(image, client=None, transport=None, notify=notify_streamlit):
+    """Turn the source photo into a request part shared by every prompt in a batch
+    
+    image is a PIL image, or the (bytes, mime_type) pair from encode_source_image.
+    """
+    if transport is None:
+        transport = SOURCE_TRANSPORT
+    if isinstance(image, Image.Image):
+        data, mime_type = encode_source_image(image)
+    else:
+        data, mime_type = image
+    digest = hashlib.sha256(data).hexdigest()
+    
+    part = types.Part.from_bytes(data=data, mime_type=mime_type)
+    if transport == "file" and client is not None:
+        try:
+            uploaded = client.files.upload(
+                file=io.BytesIO(data),
+                config=types.UploadFileConfig(mime_type=mime_type),
+            )
+            part = types.Part.from_uri(file_uri=uploaded.uri, mime_type=mime_type)
+        except Exception as e:
+            notify("warning", f"⚠️ Could not upload your photo once, sending it with each prompt instead: {str(e)}")
+    
+    return PreparedSource(part, digest, mime_type, len(data))
+
+def split_response_variants(response):
+    """Split a model response into ([parts of each returned photo], [texts])
+    
+    Every image part of every candidate is one variant; its parts are the
+    candidate's texts followed by the image, as ("text", str) / ("image", (bytes, mime_type)).
+    """
+    variants, texts = [], []
+    for candidate in (response.candidates or []) if response else []:
+        if not candidate.content or not candidate.content.parts:
+            continue
+        candidate_texts = [("text", part.text) for part in candidate.content.parts if part.text is not None]
+        images = [part.inline_data for part in candidate.content.parts if part.inline_data is not None]
+        if not images:
+            texts.extend(value for _, value in candidate_texts)
+        for inline_data in images:
+            variants.append(candidate_texts + [("image", (inline_data.data, inline_data.mime_type))])
+    return variants, texts
+
+def generate_single_photo(uploaded_image, prompt_name, prompt_description, notify=notify_streamlit, client=None, cache=None, governor=None, variants=1):
+    """Generate photos for a specific prompt (reusing cached results when they exist)
+    
+    uploaded_image is a PIL image, an encoded (bytes, mime_type) pair or a
+    PreparedSource from prepare_source_image. With variants > 1 the model is
+    asked for that many candidates in one call; any it does not return are
+    requested with concurrent single calls.
+    """
+    try:
+        model = GEMINI_MODEL
+        
+        if not isinstance(uploaded_image, PreparedSource):
+            with metrics.timer("request_serialization"):
+                uploaded_image = prepare_source_image(uploaded_image, transport="inline", notify=notify)
         
         # Create focused prompt for this specific theme with quality emphasis
         full_prompt = f"🎉 Birthday Party Photo Magic! Remove the green screen background and {prompt_description} Create a high-resolution, professional, fun, and party-ready image! Keep the person prominent and natural. Use high-quality details, sharp focus, and vibrant colors. Make it look like a professional silly party photo."
         
-        response = client.models.generate_content(
-            model=model,
-            contents=[full_prompt, uploaded_image],
-        )
+        # One cache entry per variant; the first one is shared with single-photo runs
+        def variant_key(i):
+            if cache is None:
+                return None
+            return result_key(uploaded_image.digest, full_prompt if i == 0 else f"{full_prompt}\0variant {i + 1}", model)
+        
+        variant_parts = [cache.get(variant_key(i)) if cache is not None else None for i in range(variants)]
+        missing = [i for i, parts in enumerate(variant_parts) if parts is None]
+        reused = variants - len(missing)
+        if reused:
+            notify("info", f"♻️ {prompt_name}: reused {reused} recent result{'s' if reused > 1 else ''} for this photo")
+        
+        # Variants generated by this call (the rest came from the cache)
+        fresh = set()
+        if missing:
+            if client is None:
+                client = get_generation_client()
+            
+            def request_variants(count):
+                def request():
+                    metrics.gauge_add("in_flight_requests", 1)
+                    try:
+                        with metrics.timer("model_latency"):
+                            return client.models.generate_content(
+                                model=model,
+                                contents=[full_prompt, uploaded_image.part],
+                                config=types.GenerateContentConfig(
+                                    candidate_count=count if count > 1 else None,
+                                    http_options=types.HttpOptions(timeout=int(REQUEST_TIMEOUT_S * 1000)),
+                                ),
+                            )
+                    finally:
+                        metrics.gauge_add("in_flight_requests", -1)
+                
+                def on_retry(attempt, delay, error):
+                    notify("warning", f"⏳ {prompt_name}: the AI is busy, retrying in {delay:.0f}s (attempt {attempt + 1})")
+                
+                if governor is not None:
+                    response = governor.call(request, on_retry=on_retry)
+                else:
+                    response = request()
+                
+                # Check if response and candidates exist
+                if not response or not response.candidates or len(response.candidates) == 0:
+                    notify("error", f"❌ No response from AI for {prompt_name}")
+                    return []
+                
+                found, texts = split_response_variants(response)
+                for text in texts:
+                    notify("info", f"💭 {prompt_name}: {text}")
+                if not found and not texts:
+                    notify("error", f"❌ Invalid response structure for {prompt_name}")
+                return found
+            
+            # Ask for every missing variant in one call; the model may return fewer
+            # (or not support several candidates at all)
+            if len(missing) > 1:
+                try:
+                    found = request_variants(len(missing))
+                except errors.ClientError as e:
+                    # 400: this model does not take a candidate count
+                    if e.code != 400:
+                        raise
+                    found = []
+            else:
+                found = request_variants(1)
+            
+            def request_single(_):
+                try:
+                    return request_variants(1)[:1]
+                except Exception as e:
+                    notify("error", f"❌ Error creating a variant of {prompt_name}: {str(e)}")
+                    return []
+            
+            shortfall = len(missing) - len(found)
+            if len(missing) > 1 and shortfall > 0:
+                with ThreadPoolExecutor(max_workers=shortfall, thread_name_prefix="party-variant") as executor:
+                    for single in executor.map(request_single, range(shortfall)):
+                        found.extend(single)
+            
+            # Extra images beyond what was asked for become extra variants
+            slots = missing + list(range(variants, variants + max(0, len(found) - len(missing))))
+            variant_parts.extend([None] * (len(slots) - len(missing)))
+            for slot, parts in zip(slots, found):
+                variant_parts[slot] = parts
+                fresh.add(slot)
 
         generated_images = []
+        safe_name = prompt_name.replace(" ", "_").replace("📂", "").strip()
         
-        # Check if response and candidates exist
-        if not response or not response.candidates or len(response.candidates) == 0:
-            st.error(f"❌ No response from AI for {prompt_name}")
-            return []
-        
-        candidate = response.candidates[0]
-        if not candidate.content or not candidate.content.parts:
-            st.error(f"❌ Invalid response structure for {prompt_name}")
-            return []
-        
-        for part in candidate.content.parts:
-            if part.text is not None:
-                st.info(f"💭 {prompt_name}: {part.text}")
-            elif part.inline_data is not None:
-                # Generate the image for session use only
-                safe_name = prompt_name.replace(" ", "_").replace("📂", "").strip()
-                file_name = f"party_photo_{safe_name}.jpg"
-                image = Image.open(io.BytesIO(part.inline_data.data))
+        for variant, parts in enumerate(variant_parts):
+            decoded = False
+            for kind, value in parts or []:
+                if kind == "text":
+                    notify("info", f"💭 {prompt_name}: {value}")
+                    continue
                 
-                # Process image for high quality
-                image = process_image_for_high_quality(image)
-                if image is None:
+                # Keep the encoded photo for session use only
+                with metrics.timer("response_decode"):
+                    try:
+                        data, mime_type = encode_generated_photo(value[0], value[1], notify)
+                    except Exception as e:
+                        notify("error", f"❌ {prompt_name}: the AI returned a photo that could not be read ({str(e)})")
+                        data = None
+                if data is None:
                     continue
+                decoded = True
+                
+                # Stable names per variant: party_photo_<theme>_v2.png, ...
+                suffix = f"_v{variant + 1}" if len(variant_parts) > 1 else ""
+                file_name = f"party_photo_{safe_name}{suffix}{FILE_EXTENSIONS[mime_type]}"
                 
                 # Show success message
-                st.success(f"✅ Generated: {prompt_name}")
+                notify("success", f"✅ Generated: {prompt_name}" + (f" (variant {variant + 1})" if suffix else ""))
                 
                 # Add to display list (kept in session memory only)
-                generated_images.append((image, file_name, prompt_name))
+                generated_images.append({
+                    "data": data,
+                    "mime_type": mime_type,
+                    "file_name": file_name,
+                    "prompt_name": prompt_name,
+                })
+            
+            # Cache a new variant only once its photo has decoded, so a broken
+            # response is not replayed for this photo and prompt until it expires
+            if decoded and variant in fresh and cache is not None:
+                cache.put(variant_key(variant), parts)
         
         return generated_images
         
     except Exception as e:
-        st.error(f"❌ Error creating {prompt_name} photo: {str(e)}")
+        notify("error", f"❌ Error creating {prompt_name} photo: {str(e)}")
         return []
 
-def generate_party_photos(uploaded_image, selected_prompts, custom_prompts):
-    """Generate multiple photos - one per prompt"""
-    if not selected_prompts and not custom_prompts:
-        return []
+def collect_prompts(selected_prompts, custom_prompts):
+    """Every prompt to run, in display order, as (name, description) pairs"""
+    prompts = []
+    for prompt_key in selected_prompts:
+        if prompt_key in PREDEFINED_PROMPTS:
+            prompts.append((PREDEFINED_PROMPTS[prompt_key], PREDEFINED_PROMPTS[prompt_key]))
+    for custom_prompt in custom_prompts:
+        if custom_prompt.strip():
+            prompts.append((f"Custom: {custom_prompt}", custom_prompt))
+    return prompts
+
+def start_job_session(job_id):
+    """Point this session at a job: empty gallery and ZIP, filled as the job's prompts finish"""
+    # Make sure this process runs queued work too: after an app restart, a page
+    # reconnecting to its job may be the first to need the workers
+    get_job_workers()
+    release_photos(st.session_state.generated_images)
+    st.session_state.generated_images = []
+    if st.session_state.get("zip_export") is not None:
+        st.session_state.zip_export.close()
+    st.session_state.zip_export = ZipExport(spool_bytes=ZIP_SPOOL_MB * 1024 * 1024)
+    st.session_state.zip_preset = st.session_state.output_preset
+    st.session_state.active_job = job_id
+    st.session_state.job_collected = set()
+    st.session_state.job_messages = []
+    st.query_params["job"] = job_id
+
+def collect_job_results():
+    """Move newly finished prompts of the session's job into the gallery and ZIP export
     
-    generated_images = []
-    total_photos = len(selected_prompts) + len(custom_prompts)
+    The photo bytes go to the session blob store and the gallery stays in prompt
+    order. Returns the job status, or None if the job no longer exists.
+    """
+    queue = get_job_queue()
+    job_id = st.session_state.active_job
+    status = queue.status(job_id)
+    if status is None:
+        return None
     
-    # Create progress containers
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    blobs = get_session_blobs()
+    collected = st.session_state.job_collected
+    new_photos = []
+    for task in status["tasks"]:
+        if task["status"] in ("done", "failed") and task["index"] not in collected:
+            photos, messages = queue.results(job_id, task["index"])
+            collected.add(task["index"])
+            st.session_state.job_messages.extend(messages)
+            for photo in photos:
+                photo["index"] = task["index"]
+                new_photos.append(store_photo(photo, blobs))
     
-    current_index = 0
+    if new_photos:
+        add_photos_to_export(st.session_state.zip_export, new_photos, st.session_state.zip_preset)
+        st.session_state.generated_images = sorted(
+            st.session_state.generated_images + new_photos, key=lambda photo: photo["index"]
+        )
+    return status
+
+@st.fragment(run_every=JOB_POLL_S)
+@session_tagged
+def render_job_progress():
+    """Progress of the session's running job and the photos it has finished so far
     
-    # Generate photos for predefined prompts
-    for prompt_key in selected_prompts:
-        if prompt_key in PREDEFINED_PROMPTS:
-            current_index += 1
-            prompt_name = PREDEFINED_PROMPTS[prompt_key]
-            status_text.text(f"🎨 Generating: {prompt_name}")
-            progress_bar.progress(current_index / total_photos)
-            
-            with st.spinner(f"Creating {prompt_name.lower()}..."):
-                photos = generate_single_photo(uploaded_image, prompt_name, PREDEFINED_PROMPTS[prompt_key])
-                generated_images.extend(photos)
+    Runs as a fragment polled every PARTY_JOB_POLL_S seconds, so the rest of the
+    page (inputs, theme choice) is not rerun while a job is going. Once the job
+    is over the whole page reruns once to show the gallery and ZIP, which also
+    stops the polling.
+    """
+    status = collect_job_results()
+    if status is None or status["finished"]:
+        if status is not None:
+            st.session_state.zip_export.finish()
+            if status["seconds"] and status["seconds"] > 0:
+                metrics.record("generate_batch", status["seconds"], prompts=status["total"])
+        st.session_state.job_report = status
+        st.session_state.active_job = None
+        st.rerun()
+    else:
+        for level, message in st.session_state.job_messages:
+            notify_streamlit(level, message)
+        finished = status["done"] + status["failed"]
+        st.progress(finished / status["total"])
+        st.text(f"🎨 Finished {finished}/{status['total']} themes...")
+        
+        if st.session_state.generated_images:
+            render_gallery_photos()
+            st.caption("📦 The ZIP with all photos will be ready when every photo is done")
+
+def render_gallery_photos():
+    """Every gallery photo with its download button, in prompt order"""
+    photos = st.session_state.generated_images
+    # Encode every missing download payload at once on the encode pool
+    get_download_payloads(photos, st.session_state.output_preset)
+    for i in range(len(photos)):
+        render_photo(i)
+        
+        # Add some space between photos
+        if i < len(photos) - 1:
+            st.markdown("---")
+
+@st.fragment
+@session_tagged
+def render_results():
+    """The finished gallery: download format, every photo and the ZIP download
     
-    # Generate photos for custom prompts
-    for custom_prompt in custom_prompts:
-        if custom_prompt.strip():
-            current_index += 1
-            prompt_name = "Custom Creation"
-            status_text.text(f"✨ Custom Creation: {custom_prompt}")
-            progress_bar.progress(current_index / total_photos)
-            
-            with st.spinner(f"Creating your custom idea: {custom_prompt[:30]}..."):
-                photos = generate_single_photo(uploaded_image, f"Custom: {custom_prompt}", custom_prompt)
-                generated_images.extend(photos)
+    Runs as a fragment, so switching the download format re-encodes and reruns
+    only this section.
+    """
+    st.markdown('<div class="results-section">', unsafe_allow_html=True)
+    st.markdown('### 🎉 Your Amazing Party Photos!')
+    
+    # Output preset of the downloads and the ZIP (kept outside the widget key
+    # so it survives reruns in which the results section is not shown)
+    preset_labels = {preset.label: name for name, preset in OUTPUT_PRESETS.items()}
+    st.session_state.output_preset = preset_labels[st.selectbox(
+        "📐 Download format:",
+        list(preset_labels),
+        index=list(preset_labels.values()).index(st.session_state.output_preset),
+        key="output_preset_choice"
+    )]
+    
+    # Vertical gallery for generated images
+    st.markdown(f"**📸 All {len(st.session_state.generated_images)} Party Photos:**")
+    render_gallery_photos()
+    
+    # Download options
+    st.markdown("**📥 Download Your Photos:**")
+    st.info("💾 **Note**: Photos are kept in session memory only. Download them now to save them permanently!")
+    
+    # The ZIP was built while the photos were generated; it is only rebuilt
+    # if it no longer matches the gallery
+    render_zip_download()
+    
+    st.markdown('</div>', unsafe_allow_html=True)
+
+@st.fragment
+@session_tagged
+def render_photo(index):
+    """Show the gallery photo at index with its download button
+    
+    Runs as a fragment: a download click reruns this photo only, not the gallery.
+    The photo and download format are looked up in session state on every run,
+    because a fragment rerun replays the arguments of the fragment's first call.
+    """
+    if index >= len(st.session_state.generated_images):
+        return
+    photo = st.session_state.generated_images[index]
+    # Display a pre-sized copy (made once per photo); the original is only downloaded
+    image = get_display_image(photo, GALLERY_WIDTH)
+    if image is None:
+        st.warning(f"⌛ {photo['prompt_name']}: this photo is no longer kept on the server, please generate it again")
+        return
+    show_display_image(image, GALLERY_WIDTH, f"🎨 {photo['prompt_name']}")
+    
+    # Download button below each image (payload is encoded once, then reused on reruns)
+    payload = get_download_payload(photo, st.session_state.output_preset)
+    if payload is None:
+        return
+    st.download_button(
+        label=f"📥 Download: {photo['prompt_name']}",
+        data=payload["data"],
+        file_name=payload["file_name"],
+        mime=payload["mime_type"],
+        key=f"gallery_download_{index}"
+    )
+
+@st.fragment
+@session_tagged
+def render_zip_download():
+    """ZIP download button for the whole gallery (a fragment, like render_photo)"""
+    preset_name = st.session_state.output_preset
+    try:
+        export = st.session_state.get("zip_export")
+        if (export is None or not export.finished or export.count != len(st.session_state.generated_images)
+                or st.session_state.get("zip_preset") != preset_name):
+            stale = export
+            export = build_zip_export(st.session_state.generated_images, preset_name)
+            st.session_state.zip_export = export
+            # Free the replaced archive's buffer or temp file now, not at garbage collection
+            if stale is not None:
+                stale.close()
+            st.session_state.zip_preset = preset_name
+        
+        st.download_button(
+            label="📦 Download All Photos as ZIP",
+            data=export.read(),
+            file_name="nano_banana_party_photos.zip",
+            mime="application/zip",
+            type="primary",
+            key="zip_download"
+        )
+        st.caption(f"📦 {export.count} photos, {export.size / (1024 * 1024):.1f} MB")
+        
+    except Exception as e:
+        st.error(f"❌ Error creating ZIP file: {str(e)}")
+        st.info("💡 Please try downloading individual photos above")
+
+def render_ops_panel():
+    """Sidebar with per-stage p50/p95 timings and requests in flight (PARTY_OPS_PANEL=1)"""
+    with st.sidebar:
+        st.markdown("### 🛠️ Ops Panel")
+        governor = get_request_governor()
+        in_flight = metrics.gauges().get("in_flight_requests", 0)
+        st.markdown(f"**In flight:** {in_flight} requests (limit {governor.concurrency_limit})")
+        stages = metrics.summary()
+        if stages:
+            rows = ["| Stage | Count | p50 ms | p95 ms |", "|---|---:|---:|---:|"]
+            for stage, stats in sorted(stages.items()):
+                rows.append(f"| {stage} | {stats['count']} | {stats['p50'] * 1000:.1f} | {stats['p95'] * 1000:.1f} |")
+            st.markdown("\n".join(rows))
+        else:
+            st.caption("No measurements yet")
+        st.caption(f"♻️ Result cache: {get_result_cache().summary()}")
+        st.caption(f"🗄️ Photo store: {get_blob_store().summary()}")
+
+def add_custom_prompt():
+    """Button callback: add the typed custom idea to the session's prompts"""
+    st.session_state.custom_prompts.append(st.session_state.new_prompt_input)
+
+def remove_custom_prompt(index):
+    """Button callback: remove one of the session's custom prompts"""
+    st.session_state.custom_prompts.pop(index)
+
+@st.fragment
+@session_tagged
+def render_generate_section():
+    """Steps 2 and 3: theme choice and the Generate button
     
-    # Complete progress
-    progress_bar.progress(1.0)
-    status_text.text("🎉 All photos generated successfully!")
+    Runs as a fragment, so toggling themes or editing custom prompts reruns only
+    this section rather than the whole page with its gallery.
+    """
+    st.markdown('### 🎨 Step 2: Choose Your Magic!')
+    
+    # Pre-defined prompts section
+    st.markdown('#### 🌟 Pre-made Party Themes (check all you want!):')
+    
+    selected_prompts = []
+    for prompt_key, prompt_text in PREDEFINED_PROMPTS.items():
+        if st.checkbox(prompt_text, key=f"predefined_{prompt_key}"):
+            selected_prompts.append(prompt_key)
+        
+    # Custom prompts section
+    st.markdown('#### ✨ Add Your Own Ideas:')
     
-    return generated_images
+    # Display existing custom prompts
+    if st.session_state.custom_prompts:
+        for i, custom_prompt in enumerate(st.session_state.custom_prompts):
+            col_display, col_remove = st.columns([4, 1])
+            with col_display:
+                st.write(f"💡 {custom_prompt}")
+            with col_remove:
+                st.button("🗑️", key=f"remove_{i}", help="Remove this prompt",
+                          on_click=remove_custom_prompt, args=(i,))
+    
+    # Add new custom prompt
+    new_prompt = st.text_input(
+        "💫 Add a custom idea:",
+        placeholder="e.g., Make it look like a winter wonderland",
+        key="new_prompt_input"
+    )
+    
+    st.button("➕ Add Custom Prompt", disabled=not new_prompt.strip(), on_click=add_custom_prompt)
+    
+    # Several takes on each theme, from a single request per theme
+    variants = 1
+    if MAX_VARIANTS > 1:
+        variants = st.number_input(
+            "🎲 Photos per theme:",
+            min_value=1,
+            max_value=MAX_VARIANTS,
+            value=1,
+            help="Get several different takes on each theme",
+            key="variants"
+        )
+    
+    
+    # Generate section
+    if 'current_source' in st.session_state:
+        st.markdown('### 🚀 Step 3: Create Your Magic Photo!')
+        
+        # Show selected prompts summary
+        if selected_prompts or st.session_state.custom_prompts:
+            st.markdown('**🎯 Selected Effects:**')
+            
+            # Show predefined selections
+            for prompt_key in selected_prompts:
+                st.markdown(f"✅ {PREDEFINED_PROMPTS[prompt_key]}")
+            
+            # Show custom selections
+            for custom_prompt in st.session_state.custom_prompts:
+                st.markdown(f"✅ {custom_prompt}")
+        
+        generating = st.session_state.active_job is not None
+        if st.button("🎨 Generate Magic Photos!", type="primary", disabled=generating or not (selected_prompts or st.session_state.custom_prompts)) and not generating:
+            source = st.session_state.current_source
+            source_data = read_blob(source)
+            if BACKEND != "stub" and not os.environ.get("GEMINI_API_KEY"):
+                st.error("❌ Please set your GEMINI_API_KEY in the .env file")
+            elif source_data is None:
+                st.error("❌ Your photo is no longer kept on the server, please upload it again")
+            else:
+                # Queue the job; workers (in this or another app process) run it
+                # while this page polls for results, across reruns and reconnects
+                prompts = collect_prompts(selected_prompts, st.session_state.custom_prompts)
+                job_id = get_job_queue().submit(source_data, source["mime_type"], prompts, GEMINI_MODEL, variants=variants,
+                                                session=current_session_id())
+                start_job_session(job_id)
+                
+                # Show the estimated time with the job's progress messages
+                at_a_time = JOB_WORKERS or MAX_PARALLEL_REQUESTS
+                batches = -(-len(prompts) // at_a_time)
+                st.session_state.job_messages.append(("info", f"⏱️ Generating {len(prompts) * variants} photos ({variants} per prompt selected, up to {at_a_time} prompts at a time). This may take {batches * 15}-{batches * 30} seconds..."))
+                # Rerun the whole page (not just this section) to follow the job
+                st.rerun()
 
 def main():
+    setup_page()
+    
+    # Tag this run's measurements with the browser session
+    if metrics.enabled:
+        metrics.set_tags(session=current_session_id())
+        metrics.start_server()
+        if metrics.OPS_PANEL:
+            render_ops_panel()
+    
     # Header
     st.markdown('<h1 class="main-header">🍌 Nano Banana Party Photo Editor</h1>', unsafe_allow_html=True)
     st.markdown('<div style="text-align: center; font-size: 18px; color: #666; margin-bottom: 2rem;">📱 Take photos with camera or upload from gallery with greenscreen background to create magical party memories! ✨</div>', unsafe_allow_html=True)
@@ -292,6 +1299,13 @@ def main():
         st.session_state.generated_images = []
     if 'custom_prompts' not in st.session_state:
         st.session_state.custom_prompts = []
+    if 'output_preset' not in st.session_state:
+        st.session_state.output_preset = DEFAULT_OUTPUT_PRESET
+    # Pick up the job this browser started before it reconnected (its id is kept in the URL)
+    if 'active_job' not in st.session_state:
+        st.session_state.active_job = None
+        if st.query_params.get("job"):
+            start_job_session(st.query_params["job"])
     
     # Single column mobile-first layout
     st.markdown('### 📸 Step 1: Take Your Photo')
@@ -303,6 +1317,7 @@ def main():
     tab1, tab2 = st.tabs(["📁 File Upload", "📱 Camera Input"])
     
     current_image = None
+    current_file = None
     image_source = None
     
     with tab1:
@@ -318,10 +1333,12 @@ def main():
         
         if uploaded_file is not None:
             try:
-                raw_image = Image.open(uploaded_file)
-                current_image = process_image_for_high_quality(raw_image)
+                # Cached across reruns: toggling themes does not reprocess the photo
+                current_image = load_source_photo(uploaded_file)
                 if current_image:
-                    resolution = f"{current_image.width}x{current_image.height}"
+                    current_file = uploaded_file
+                    # The photo as taken; large ones are scaled down on upload
+                    resolution = "{}x{}".format(*current_image.info.get("original_size", current_image.size))
                     image_source = "File Upload"
                     st.success(f"✅ Photo loaded! Resolution: {resolution} pixels")
                     st.info("💡 Great! This resolution will work perfectly for creating amazing party photos!")
@@ -343,10 +1360,12 @@ def main():
         
         if camera_photo is not None:
             try:
-                raw_image = Image.open(camera_photo)
-                current_image = process_image_for_high_quality(raw_image)
+                # Cached across reruns: toggling themes does not reprocess the photo
+                current_image = load_source_photo(camera_photo)
                 if current_image:
-                    resolution = f"{current_image.width}x{current_image.height}"
+                    current_file = camera_photo
+                    # The photo as taken; large ones are scaled down on upload
+                    resolution = "{}x{}".format(*current_image.info.get("original_size", current_image.size))
                     image_source = "Camera Input"
                     st.success(f"✅ Photo captured! Resolution: {resolution} pixels")
                     st.info("💡 Great! This resolution will work perfectly for creating amazing party photos!")
@@ -359,23 +1378,43 @@ def main():
     # Display the image if successfully loaded
     if current_image is not None:
         try:
-            # Resize image for mobile display while maintaining aspect ratio
-            display_width = min(400, current_image.width)
-            aspect_ratio = current_image.height / current_image.width
-            display_height = int(display_width * aspect_ratio)
+            # Store the encoded photo in session state (not its pixels), encoding it
+            # again only when a different photo comes in or the old one was evicted
+            file_id = getattr(current_file, "file_id", None)
+            prekeyed = CHROMA_PREVIEW and st.session_state.get("send_prekeyed", False)
+            source = st.session_state.get("current_source")
+            if (source is None or source["file_id"] != file_id or source.get("prekeyed") != prekeyed
+                    or source["blob"] not in get_blob_store()):
+                blobs = get_session_blobs()
+                if source is not None:
+                    release_photos([source])
+                chroma = None
+                send_image = current_image
+                if CHROMA_PREVIEW:
+                    with metrics.timer("chroma_key"):
+                        key = chroma_key.analyze(current_image)
+                    chroma = {"score": key.score, "issues": key.issues, "found": key.key_color is not None,
+                              "coverage": key.coverage, "fuzz": key.fuzz, "spill": key.spill}
+                    if prekeyed and key.key_color is not None:
+                        with metrics.timer("chroma_prekey"):
+                            send_image = chroma_key.prekey(current_image, key.key_color)
+                data, mime_type = encode_source_image(send_image)
+                source = {"file_id": file_id, "blob": blobs.put(data), "mime_type": mime_type,
+                          "prekeyed": prekeyed, "chroma": chroma}
+                st.session_state.current_source = source
             
-            st.image(
-                current_image, 
-                caption=f"🎭 Your Original Greenscreen Photo ({image_source})", 
-                width=display_width
+            # Show a copy resized once for the preview slot (kept with the source
+            # photo); a pre-keyed photo is shown as it will be sent
+            display_width = min(PREVIEW_WIDTH, current_image.width)
+            show_display_image(
+                get_display_image(source, display_width, source=None if source["prekeyed"] else current_image),
+                display_width,
+                f"🎭 Your Original Greenscreen Photo ({image_source})"
             )
             
-            # Store in session state
-            st.session_state.current_image = current_image
-            
             # Show detailed image info with quality assessment
             total_pixels = current_image.width * current_image.height
-            st.info(f"📊 **Photo Details:** {current_image.width}x{current_image.height} pixels ({total_pixels:,} total pixels), {current_image.mode} mode")
+            st.info(f"📊 **Photo Details:** {current_image.width}x{current_image.height} pixels as sent to the model ({total_pixels:,} total pixels), {current_image.mode} mode")
             
             # Quality assessment
             if total_pixels >= 500000:  # 500k pixels or more
@@ -385,6 +1424,36 @@ def main():
             else:
                 st.warning("⚠️ **Lower Resolution** - but still good enough for fun party photos!")
             
+            # Green screen check from the local chroma key (no model call)
+            chroma = source["chroma"]
+            if chroma is not None:
+                if chroma["score"] >= 80:
+                    st.success(f"🟩 **Clean Green Screen!** Key quality {chroma['score']}/100 - the background will come off nicely")
+                elif chroma["score"] >= 50:
+                    st.warning(f"🟨 **Green Screen Could Be Better** - key quality {chroma['score']}/100")
+                else:
+                    st.error(f"🟥 **Green Screen Problems** - key quality {chroma['score']}/100. Try fixing these before generating:")
+                for issue in chroma["issues"]:
+                    st.markdown(f"- {issue}")
+                
+                if chroma["found"]:
+                    st.caption(f"🟩 Screen {chroma['coverage']:.0%} of the photo, soft edges {chroma['fuzz']:.1%}, green spill on the person {chroma['spill']:.0%}")
+                    with st.expander("✂️ Green screen preview"):
+                        # Keyed at preview size, memoized with the source photo like its preview
+                        show_display_image(
+                            get_display_image(
+                                source, display_width, view="keyed",
+                                source=lambda: chroma_key.preview(current_image, chroma_key.analyze(current_image)),
+                            ),
+                            display_width,
+                            "✂️ Your photo with the green screen removed"
+                        )
+                    st.checkbox(
+                        "✂️ Send the photo with its green screen already removed",
+                        help="The screen is replaced by an even, flat green before the photo goes to the model. Helps with creased or unevenly lit screens.",
+                        key="send_prekeyed"
+                    )
+            
         except Exception as e:
             st.error(f"❌ Error displaying image: {str(e)}")
             st.info("💡 The image might be corrupted or in an unsupported format")
@@ -393,170 +1462,36 @@ def main():
 
     st.markdown('</div>', unsafe_allow_html=True)
     
-    #st.markdown('<div class="party-section">', unsafe_allow_html=True)
-    st.markdown('### 🎨 Step 2: Choose Your Magic!')
-    
-    # Pre-defined prompts section
-    st.markdown('#### 🌟 Pre-made Party Themes (check all you want!):')
-    
-    selected_prompts = []
-    for prompt_key, prompt_text in PREDEFINED_PROMPTS.items():
-        if st.checkbox(prompt_text, key=f"predefined_{prompt_key}"):
-            selected_prompts.append(prompt_key)
-        
-    # Custom prompts section
-    st.markdown('#### ✨ Add Your Own Ideas:')
-    
-    # Display existing custom prompts
-    if st.session_state.custom_prompts:
-        for i, custom_prompt in enumerate(st.session_state.custom_prompts):
-            col_display, col_remove = st.columns([4, 1])
-            with col_display:
-                st.write(f"💡 {custom_prompt}")
-            with col_remove:
-                if st.button("🗑️", key=f"remove_{i}", help="Remove this prompt"):
-                    st.session_state.custom_prompts.pop(i)
-                    st.rerun()
+    render_generate_section()
     
-    # Add new custom prompt
-    new_prompt = st.text_input(
-        "💫 Add a custom idea:",
-        placeholder="e.g., Make it look like a winter wonderland",
-        key="new_prompt_input"
-    )
-    
-    if st.button("➕ Add Custom Prompt", disabled=not new_prompt.strip()):
-        st.session_state.custom_prompts.append(new_prompt)
-        st.rerun()
+    if st.session_state.get("active_job"):
+        # Follow the session's job; only this section reruns while it polls
+        render_job_progress()
+    elif "job_report" in st.session_state:
+        # How the job that just finished went (shown on the run that ends the polling)
+        status = st.session_state.pop("job_report")
+        for level, message in st.session_state.job_messages:
+            notify_streamlit(level, message)
+        if status is None:
+            st.warning("⌛ This generation job is no longer available, please generate again")
+        else:
+            st.success(f"🎉 Successfully generated {len(st.session_state.generated_images)} amazing photos!")
+            st.caption(f"♻️ Result cache (all guests): {get_result_cache().summary()}")
     
+    # Drop gallery entries whose photos were evicted from the blob store
+    if st.session_state.generated_images and not st.session_state.get("active_job"):
+        store = get_blob_store()
+        kept, evicted = [], []
+        for photo in st.session_state.generated_images:
+            (kept if "data" in photo or photo["blob"] in store else evicted).append(photo)
+        if evicted:
+            st.warning(f"⌛ {len(evicted)} older photos are no longer kept on the server")
+            release_photos(evicted)
+            st.session_state.generated_images = kept
     
-    # Generate section
-    if 'current_image' in st.session_state:
-        st.markdown('### 🚀 Step 3: Create Your Magic Photo!')
-        
-        # Show selected prompts summary
-        if selected_prompts or st.session_state.custom_prompts:
-            st.markdown('**🎯 Selected Effects:**')
-            
-            # Show predefined selections
-            for prompt_key in selected_prompts:
-                st.markdown(f"✅ {PREDEFINED_PROMPTS[prompt_key]}")
-            
-            # Show custom selections
-            for custom_prompt in st.session_state.custom_prompts:
-                st.markdown(f"✅ {custom_prompt}")
-        
-        if st.button("🎨 Generate Magic Photos!", type="primary", disabled=not (selected_prompts or st.session_state.custom_prompts)):
-            if not os.environ.get("GEMINI_API_KEY"):
-                st.error("❌ Please set your GEMINI_API_KEY in the .env file")
-            else:
-                # Show estimated time
-                total_prompts = len(selected_prompts) + len(st.session_state.custom_prompts)
-                st.info(f"⏱️ Generating {total_prompts} photos (1 per prompt selected). This may take {total_prompts * 15-30} seconds...")
-                
-                # Generate the photos
-                generated_images = generate_party_photos(
-                    st.session_state.current_image,
-                    selected_prompts,
-                    st.session_state.custom_prompts
-                )
-                
-                # Store generated images in session state
-                st.session_state.generated_images = generated_images
-                
-                # Show completion message
-                st.success(f"🎉 Successfully generated {len(generated_images)} amazing photos!")
-        
-        st.markdown('</div>', unsafe_allow_html=True)
-    
-    # Results section
-    if 'generated_images' in st.session_state and st.session_state.generated_images:
-        st.markdown('<div class="results-section">', unsafe_allow_html=True)
-        st.markdown('### 🎉 Your Amazing Party Photos!')
-        
-        # Vertical gallery for generated images
-        total_images = len(st.session_state.generated_images)
-        
-        if total_images > 0:
-            st.markdown(f"**📸 All {total_images} Party Photos:**")
-            
-            for i, image_data in enumerate(st.session_state.generated_images):
-                # Handle different image data formats
-                if len(image_data) == 3:
-                    image, filename, prompt_name = image_data
-                    caption = f"🎨 {prompt_name}"
-                else:
-                    image, filename = image_data
-                    caption = f"🎨 Photo {i + 1}"
-                
-                # Display image
-                st.image(image, caption=caption, width=500)
-                
-                # Download button below each image
-                download_label = f"📥 Download: {prompt_name}" if len(image_data) == 3 else f"📥 Download Photo {i + 1}"
-                
-                # Create download button with maximum quality
-                buf = io.BytesIO()
-                image.save(buf, format='JPEG', quality=100, optimize=False)
-                byte_im = buf.getvalue()
-                
-                st.download_button(
-                    label=download_label,
-                    data=byte_im,
-                    file_name=filename,
-                    mime="image/jpeg",
-                    key=f"gallery_download_{i}"
-                )
-                
-                # Add some space between photos
-                if i < total_images - 1:
-                    st.markdown("---")
-        
-        # Download options
-        st.markdown("**📥 Download Your Photos:**")
-        st.info("💾 **Note**: Photos are kept in session memory only. Download them now to save them permanently!")
-        
-        # Create zip file with all photos
-        if st.button("📦 Download All Photos as ZIP", type="primary", key="download_all"):
-            try:
-                # Create a zip file in memory
-                zip_buffer = io.BytesIO()
-                
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for i, image_data in enumerate(st.session_state.generated_images):
-                        if len(image_data) == 3:
-                            image, filename, prompt_name = image_data
-                        else:
-                            image, filename = image_data
-                            prompt_name = f"Photo_{i+1}"
-                        
-                        # Create high-quality image data
-                        img_buffer = io.BytesIO()
-                        image.save(img_buffer, format='JPEG', quality=100, optimize=False)
-                        img_buffer.seek(0)
-                        
-                        # Add to zip with clean filename
-                        clean_filename = filename.replace(" ", "_").replace(":", "").replace("🎨", "").replace("📥", "")
-                        zip_file.writestr(clean_filename, img_buffer.getvalue())
-                
-                zip_buffer.seek(0)
-                
-                # Create download button for zip file
-                st.download_button(
-                    label="📦 Download All Photos (ZIP)",
-                    data=zip_buffer.getvalue(),
-                    file_name="nano_banana_party_photos.zip",
-                    mime="application/zip",
-                    key="zip_download"
-                )
-                
-                st.success(f"🎉 ZIP file created with {total_images} high-quality photos!")
-                
-            except Exception as e:
-                st.error(f"❌ Error creating ZIP file: {str(e)}")
-                st.info("💡 Please try downloading individual photos below")
-        
-        st.markdown('</div>', unsafe_allow_html=True)
+    # Results section (while a job runs, render_job_progress shows its photos)
+    if st.session_state.generated_images and not st.session_state.get("active_job"):
+        render_results()
     
     # Footer
     st.markdown("---")
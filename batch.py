@@ -0,0 +1,248 @@
+"""Headless batch run: every photo in a directory through a list of themes.
+
+For reprints after the event. Uses the same pipeline as the app
+(process_image_for_high_quality, prepare_source_image, generate_single_photo)
+and the same settings (GEMINI_API_KEY, PARTY_* limits, result cache), without
+any Streamlit calls::
+
+    python batch.py shoot/ reprints/                          # all pre-made themes
+    python batch.py shoot/ reprints/ --themes shroomy --prompt "winter wonderland"
+    python batch.py shoot/ reprints/ --preset share --workers 8
+
+Photos are decoded one at a time and at most --workers prompts are in flight.
+Outputs land in OUTPUT_DIR/<photo path>/ (extension included, so a.jpg and
+a.png stay apart) and every finished (photo, theme) is appended to
+OUTPUT_DIR/manifest.jsonl as it completes. Running the same command again skips
+the pairs the manifest records as done (for the same photo content, --variants
+and --preset) and retries the failed ones.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+INPUT_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+# Longest output file name kept as is, in bytes (most file systems allow 255)
+MAX_FILE_NAME_BYTES = 160
+
+
+def parse_args(app, argv=None):
+    parser = argparse.ArgumentParser(description="Run a directory of photos through party themes")
+    parser.add_argument("input_dir", help="directory with the source photos")
+    parser.add_argument("output_dir", help="directory for the generated photos and manifest.jsonl")
+    parser.add_argument("--themes", default=",".join(app.PREDEFINED_PROMPTS),
+                        help=f"comma-separated pre-made themes, empty for none (default: all of {', '.join(app.PREDEFINED_PROMPTS)})")
+    parser.add_argument("--prompt", action="append", default=[], help="custom prompt (repeatable)")
+    parser.add_argument("--variants", type=int, default=1, help="photos per theme")
+    parser.add_argument("--workers", type=int, default=app.MAX_PARALLEL_REQUESTS,
+                        help="prompts in flight at the same time (default: PARTY_MAX_PARALLEL_REQUESTS)")
+    parser.add_argument("--preset", default=app.DEFAULT_OUTPUT_PRESET, choices=list(app.OUTPUT_PRESETS),
+                        help="output encoding preset (default: PARTY_OUTPUT_PRESET)")
+    parser.add_argument("--recursive", action="store_true", help="also read photos in subdirectories")
+    parser.add_argument("--manifest", help="manifest path (default: OUTPUT_DIR/manifest.jsonl)")
+    return parser.parse_args(argv)
+
+
+def find_photos(input_dir, recursive):
+    """Paths of the input photos, relative to input_dir, in a stable order"""
+    photos = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(INPUT_EXTENSIONS):
+                photos.append(os.path.relpath(os.path.join(root, name), input_dir))
+        if not recursive:
+            break
+    return photos
+
+
+def read_manifest(path):
+    """(photo, digest, prompt, variants, preset) of every pair the manifest records as done"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run
+                continue
+            if record.get("status") == "done":
+                done.add((record["photo"], record["digest"], record["prompt"],
+                          record.get("variants", 1), record.get("preset")))
+    return done
+
+
+def clean_file_name(name):
+    """A file name for an output photo; long ones (custom prompts) are cut and given a hash"""
+    name = name.replace(" ", "_").replace(":", "").replace("/", "_").replace("🎨", "").replace("📥", "")
+    if len(name.encode("utf-8")) <= MAX_FILE_NAME_BYTES:
+        return name
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(name.encode("utf-8")).hexdigest()[:12]
+    stem = stem.encode("utf-8")[:MAX_FILE_NAME_BYTES - len(ext.encode("utf-8")) - 13].decode("utf-8", "ignore")
+    return f"{stem}_{digest}{ext}"
+
+
+def main(argv=None):
+    import app
+    import metrics
+    from PIL import Image
+    from output_encoder import encode_bytes
+
+    args = parse_args(app, argv)
+    themes = [theme for theme in args.themes.split(",") if theme]
+    unknown = [theme for theme in themes if theme not in app.PREDEFINED_PROMPTS]
+    if unknown:
+        print(f"❌ Unknown themes: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    prompts = app.collect_prompts(themes, args.prompt)
+    if not prompts:
+        print("❌ No themes or prompts to run", file=sys.stderr)
+        return 2
+    if app.BACKEND != "stub" and not os.environ.get("GEMINI_API_KEY"):
+        print("❌ Please set GEMINI_API_KEY (or PARTY_BACKEND=stub)", file=sys.stderr)
+        return 2
+
+    photos = find_photos(args.input_dir, args.recursive)
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.output_dir, "manifest.jsonl")
+    done = read_manifest(manifest_path)
+    preset = app.OUTPUT_PRESETS[args.preset]
+
+    # Shared the way a server process shares them (st.cache_resource does not
+    # cache outside a Streamlit script run)
+    client, cache, governor = app.get_generation_client(), app.get_result_cache(), app.get_request_governor()
+    quiet = lambda level, message: None
+
+    total = len(photos) * len(prompts)
+    skipped, outputs, failures = 0, 0, Counter()
+    finished = 0
+    started = time.perf_counter()
+    print(f"🍌 {len(photos)} photos × {len(prompts)} themes from {args.input_dir} ({args.workers} at a time)")
+
+    def run_task(source, prompt_name, prompt_description):
+        messages = []
+        task_started = time.perf_counter()
+        with metrics.tags(prompt=prompt_name):
+            photos = app.generate_single_photo(
+                source,
+                prompt_name,
+                prompt_description,
+                notify=lambda level, message: messages.append((level, message)),
+                client=client,
+                cache=cache,
+                governor=governor,
+                variants=args.variants,
+            )
+        # Encode in the worker thread too (Pillow releases the GIL)
+        encoded = []
+        for photo in photos:
+            data, mime_type = encode_bytes(photo["data"], photo["mime_type"], preset)
+            file_name = os.path.splitext(photo["file_name"])[0] + app.FILE_EXTENSIONS[mime_type]
+            encoded.append((clean_file_name(file_name), data))
+        return encoded, messages, time.perf_counter() - task_started
+
+    def record_result(manifest, photo, digest, prompt_name, future):
+        nonlocal outputs, finished
+        finished += 1
+        try:
+            encoded, messages, seconds = future.result()
+        except Exception as e:
+            encoded, messages, seconds = [], [("error", f"❌ {prompt_name}: {e}")], None
+        # The whole relative path names the directory, so a.jpg and a.png do not
+        # write over each other's outputs
+        photo_dir = os.path.join(args.output_dir, photo)
+        paths = []
+        try:
+            os.makedirs(photo_dir, exist_ok=True)
+            for file_name, data in encoded:
+                path = os.path.join(photo_dir, file_name)
+                with open(path, "wb") as f:
+                    f.write(data)
+                paths.append(os.path.relpath(path, args.output_dir))
+        except OSError as e:
+            messages.append(("error", f"❌ {prompt_name}: could not write the photo: {e}"))
+            paths = []
+        errors = [message for level, message in messages if level == "error"]
+        status = "done" if paths else "failed"
+        manifest.write(json.dumps({
+            "photo": photo, "digest": digest, "prompt": prompt_name, "variants": args.variants,
+            "preset": args.preset, "status": status, "outputs": paths, "errors": errors,
+            "seconds": round(seconds, 3) if seconds else None, "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, ensure_ascii=False) + "\n")
+        manifest.flush()
+
+        outputs += len(paths)
+        if status == "failed":
+            failures[errors[-1] if errors else "no photo returned"] += 1
+        rate = outputs / max(time.perf_counter() - started, 1e-9) * 60
+        icon = "✅" if status == "done" else "❌"
+        print(f"{icon} [{finished + skipped}/{total}] {photo} × {prompt_name} ({rate:.1f} photos/min)", flush=True)
+
+    with open(manifest_path, "a", encoding="utf-8") as manifest, \
+            ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="party-batch") as executor:
+        pending = {}
+
+        def drain(limit):
+            # Handle finished prompts until at most `limit` are still in flight
+            while len(pending) > limit:
+                completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    record_result(manifest, *pending.pop(future), future)
+
+        for photo in photos:
+            with open(os.path.join(args.input_dir, photo), "rb") as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            todo = [(name, description) for name, description in prompts
+                    if (photo, digest, name, args.variants, args.preset) not in done]
+            skipped += len(prompts) - len(todo)
+            if not todo:
+                continue
+
+            # Decode and encode each photo once, only when it still has work
+            try:
+                image = app.process_image_for_high_quality(Image.open(io.BytesIO(data)), quiet, max_edge=app.SOURCE_MAX_EDGE)
+            except Exception:
+                image = None
+            source = app.prepare_source_image(image, client=client, notify=quiet) if image is not None else None
+            if source is None:
+                for name, _ in todo:
+                    failures["could not read the photo"] += 1
+                    manifest.write(json.dumps({"photo": photo, "digest": digest, "prompt": name, "variants": args.variants,
+                                               "preset": args.preset, "status": "failed", "outputs": [],
+                                               "errors": ["could not read the photo"]},
+                                              ensure_ascii=False) + "\n")
+                    finished += 1
+                manifest.flush()
+                print(f"❌ {photo}: could not read the photo", flush=True)
+                continue
+
+            for name, description in todo:
+                # Keep the queue short so sources of later photos are not held in memory
+                drain(args.workers * 2 - 1)
+                pending[executor.submit(run_task, source, name, description)] = (photo, digest, name)
+        drain(0)
+
+    elapsed = time.perf_counter() - started
+    failed = sum(failures.values())
+    print(f"🎉 {outputs} photos in {elapsed:.1f}s ({outputs / max(elapsed, 1e-9) * 60:.1f} photos/min), "
+          f"{finished - failed} themes done, {failed} failed, {skipped} already done")
+    if failures:
+        print("❌ Failures:")
+        for error, count in failures.most_common():
+            print(f"  {count} × {error}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+"""Stage-level benchmarks for the party photo pipeline, fully offline.
+
+Runs the real app.py code against the stub model from stub_backend and reports
+latency percentiles and throughput per stage:
+
+* upload_decode    process_image_for_high_quality on a fresh JPEG upload
+* source_encode    prepare_source_image (the request payload sent to the model)
+* chroma_key       chroma_key.analyze, the green screen check at preview size
+* generate_batch   a job of 1..N prompts through the job queue and its workers,
+                   from submit until every result is read back
+* response_decode  encode_generated_photo, with and without passthrough
+* gallery_encode   get_download_payload in the original, share and archive presets
+* display_encode   make_display_image, the pre-sized copy shown in the gallery
+* zip_export       build_zip_export for a gallery of N photos (original and share)
+
+Usage::
+
+    python benchmarks/bench.py                               # print a report
+    python benchmarks/bench.py --json results.json           # also save it
+    python benchmarks/bench.py --baseline benchmarks/baseline.json
+    python benchmarks/bench.py --runs 3 --save-baseline benchmarks/baseline.json
+
+With --baseline, any stage whose p50 is more than --tolerance (and at least
+--min-delta-ms) slower than the baseline is reported as a regression and the
+exit code is 1, as is a stage the baseline has no entry for. A change that adds
+a stage or changes what one measures re-records the baseline, with --runs 3 or
+more: each stage then keeps the run with its median p50, which evens out the
+run-to-run noise of a busy machine.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline stage benchmarks for the party photo pipeline")
+    parser.add_argument("--prompts", default="1,2,4,6", help="comma-separated batch sizes")
+    parser.add_argument("--resolutions", default="1024x768,4000x3000,8000x6000", help="comma-separated input sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per stage")
+    parser.add_argument("--runs", type=int, default=1, help="full runs; each stage reports its median run")
+    parser.add_argument("--latency", type=float, default=0.5, help="stub model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random stub latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub requests that fail")
+    parser.add_argument("--rpm", type=float, default=1_000_000,
+                        help="governor requests per minute (default: effectively unlimited)")
+    parser.add_argument("--output-edge", type=int, default=1024, help="edge of the stub's output image")
+    parser.add_argument("--transport", choices=("inproc", "http"), default="inproc",
+                        help="call the stub in-process or through the real SDK over local HTTP")
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON baseline")
+    parser.add_argument("--save-baseline", help="write results as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown vs the baseline")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="ignore p50 differences smaller than this (timer noise on fast stages)")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """Settings app.py reads at import time: offline stub, no result cache"""
+    os.environ["PARTY_STUB_LATENCY_S"] = str(args.latency)
+    os.environ["PARTY_STUB_JITTER_S"] = str(args.jitter)
+    os.environ["PARTY_STUB_ERROR_RATE"] = str(args.error_rate)
+    os.environ["PARTY_STUB_OUTPUT_EDGE"] = str(args.output_edge)
+    os.environ["PARTY_REQUESTS_PER_MINUTE"] = str(args.rpm)
+    os.environ["PARTY_CACHE_DIR"] = ""
+    os.environ["PARTY_CACHE_MEMORY_MB"] = "0"
+    if args.transport == "http":
+        from stub_backend import StubBackend, serve_http
+
+        server = serve_http(StubBackend.from_env())
+        os.environ["PARTY_BACKEND"] = "gemini"
+        os.environ["PARTY_GEMINI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+        os.environ["GEMINI_API_KEY"] = "stub"
+    else:
+        os.environ["PARTY_BACKEND"] = "stub"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples, items_per_sample=1):
+    """Latency percentiles (ms) and throughput (items/s) for a list of durations"""
+    total = sum(samples)
+    return {
+        "n": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "throughput_per_s": round(items_per_sample * len(samples) / total, 3) if total else None,
+    }
+
+
+def measure(repeat, fn, setup=None):
+    """Run fn repeat times (setup excluded from timing) and return the durations"""
+    samples = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn(arg) if setup is not None else fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def synthetic_upload(width, height):
+    """JPEG bytes shaped like a phone photo of the given size"""
+    from PIL import Image
+
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), Image.new("L", (width, height), 90)))
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def run(args):
+    import app
+    from job_queue import JobQueue
+    from PIL import Image
+    from stub_backend import synthetic_photo
+
+    # st.cache_resource only caches inside a Streamlit script run, so pin the
+    # process-wide objects the way a long-running server would share them
+    client, governor, cache = app.get_generation_client(), app.get_request_governor(), app.get_result_cache()
+    app.get_generation_client = lambda: client
+    app.get_request_governor = lambda: governor
+    app.get_result_cache = lambda: cache
+
+    quiet = lambda level, message: None
+    results = {}
+
+    resolutions = [tuple(int(v) for v in r.split("x")) for r in args.resolutions.split(",") if r]
+    batch_sizes = [int(n) for n in args.prompts.split(",") if n]
+
+    source = None
+    for width, height in resolutions:
+        label = f"{width}x{height}"
+        upload = synthetic_upload(width, height)
+        results[f"upload_decode[{label}]"] = summarize(measure(
+            args.repeat,
+            # load() so small uploads that need no resize are still fully decoded
+            lambda image: app.process_image_for_high_quality(image, quiet, max_edge=app.SOURCE_MAX_EDGE).load(),
+            setup=lambda: Image.open(io.BytesIO(upload)),
+        ))
+        processed = app.process_image_for_high_quality(Image.open(io.BytesIO(upload)), quiet, max_edge=app.SOURCE_MAX_EDGE)
+        results[f"source_encode[{label}]"] = summarize(measure(
+            args.repeat, lambda: app.prepare_source_image(processed, transport="inline", notify=quiet),
+        ))
+        results[f"chroma_key[{label}]"] = summarize(measure(
+            args.repeat, lambda: app.chroma_key.analyze(processed),
+        ))
+        source = processed
+
+    # The path a Generate click takes: submit a job, let this process's workers
+    # run it, poll its status and read the results back
+    queue = JobQueue(tempfile.mkdtemp(prefix="party_bench_jobs_"), lease_seconds=600)
+    app.start_job_workers(queue, app.JOB_WORKERS or app.GEMINI_POOL_SIZE, client=client, cache=cache, governor=governor)
+    source_data, source_mime = app.encode_source_image(source)
+    photos = []
+    for count in batch_sizes:
+        samples = []
+        for sample in range(args.repeat):
+            # Fresh prompts every sample, or the queue would hand back the finished job
+            prompts = app.collect_prompts([], [f"benchmark prompt {count}.{sample}.{i}" for i in range(count)])
+            start = time.perf_counter()
+            job_id = queue.submit(source_data, source_mime, prompts, app.GEMINI_MODEL)
+            while not queue.status(job_id)["finished"]:
+                time.sleep(0.005)
+            photos = [photo for index in range(count) for photo in queue.results(job_id, index)[0]]
+            samples.append(time.perf_counter() - start)
+        results[f"generate_batch[{count}]"] = summarize(samples, items_per_sample=count)
+    shutil.rmtree(queue.directory, ignore_errors=True)
+
+    stub_payload = photos[0]["data"] if photos else synthetic_photo(args.output_edge)
+    # normalize re-encodes with the archive preset (progressive, quality 95,
+    # 4:4:4): several times the CPU of a plain quality 100 JPEG, for files about
+    # 30% smaller. Only outputs in an unknown format or over MAX_IMAGE_EDGE take it
+    for passthrough in (True, False):
+        app.OUTPUT_PASSTHROUGH = passthrough
+        results[f"response_decode[{'passthrough' if passthrough else 'normalize'}]"] = summarize(measure(
+            args.repeat, lambda: app.encode_generated_photo(stub_payload, "image/png", quiet),
+        ))
+    app.OUTPUT_PASSTHROUGH = True
+
+    photo = {"data": stub_payload, "mime_type": "image/png", "file_name": "party_photo_bench.png", "prompt_name": "bench"}
+    for preset_name in ("original", "share", "archive"):
+        results[f"gallery_encode[{preset_name}]"] = summarize(measure(
+            args.repeat, lambda entry: app.get_download_payload(entry, preset_name), setup=lambda: dict(photo),
+        ))
+
+    results["display_encode[gallery]"] = summarize(measure(
+        args.repeat, lambda: app.make_display_image(stub_payload, app.GALLERY_WIDTH),
+    ))
+
+    for count in batch_sizes:
+        gallery = [dict(photo, file_name=f"party_photo_{i}.png") for i in range(count)]
+        results[f"zip_export[{count}]"] = summarize(measure(
+            args.repeat, lambda: app.build_zip_export(gallery, "original").close(),
+        ), items_per_sample=count)
+        # The share preset re-encodes every photo, spread over the encode pool
+        results[f"zip_export[{count},share]"] = summarize(measure(
+            args.repeat,
+            lambda photos: app.build_zip_export(photos, "share").close(),
+            setup=lambda: [dict(entry) for entry in gallery],
+        ), items_per_sample=count)
+
+    return results
+
+
+def median_run(runs):
+    """Per stage, the stats of the run with the median p50"""
+    return {
+        stage: sorted((results[stage] for results in runs), key=lambda stats: stats["p50_ms"])[len(runs) // 2]
+        for stage in runs[0]
+    }
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Stages whose p50 got slower than the baseline by more than tolerance"""
+    regressions = []
+    for stage, stats in results.items():
+        base = baseline.get("results", {}).get(stage)
+        if (base and stats["p50_ms"] > base["p50_ms"] * (1 + tolerance)
+                and stats["p50_ms"] - base["p50_ms"] >= min_delta_ms):
+            regressions.append((stage, base["p50_ms"], stats["p50_ms"]))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, ROOT)
+    configure_environment(args)
+
+    results = median_run([run(args) for _ in range(max(1, args.runs))])
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "transport": args.transport,
+            "stub_latency_s": args.latency,
+            "repeat": args.repeat,
+            "runs": args.runs,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+    print(f"{'stage':<34}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'items/s':>12}")
+    for stage, stats in results.items():
+        print(f"{stage:<34}{stats['p50_ms']:>12.1f}{stats['p95_ms']:>12.1f}{stats['p99_ms']:>12.1f}{stats['throughput_per_s']:>12.2f}")
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+                f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        missing = [stage for stage in results if stage not in baseline.get("results", {})]
+        if regressions:
+            print(f"\n❌ {len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}:")
+            for stage, before, after in regressions:
+                print(f"  {stage}: {before:.1f} ms -> {after:.1f} ms")
+        if missing:
+            print(f"\n❌ {len(missing)} stage(s) not in the baseline (re-record it with --save-baseline):")
+            for stage in missing:
+                print(f"  {stage}")
+        if regressions or missing:
+            return 1
+        print(f"\n✅ No stage slower than the baseline by more than {args.tolerance:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,505 @@
+"""Multi-session load test for app.py against the offline stub model.
+
+Starts a real ``streamlit run app.py`` server (PARTY_BACKEND=stub, no result
+cache) for each concurrency level and drives N simulated guests through it
+with a headless client speaking Streamlit's browser protocol (websocket +
+protobuf, file upload over HTTP). Each guest:
+
+1. opens the page
+2. uploads its own photo (so no two guests share results)
+3. ticks --themes pre-made themes
+4. clicks Generate and follows the job (rerunning its polling fragment) until
+   the gallery and ZIP are shown
+5. loads the gallery images, clicks one photo download and fetches it
+6. fetches the ZIP
+7. unticks a theme again, now with a full gallery on the page
+
+It reports, per level: rerun latency percentiles (time from sending an
+interaction to the end of the script run, all interaction kinds together and
+per kind), generation throughput, and the server's RSS (idle baseline, peak,
+and what the sessions still hold at the end, per session). Linux only (RSS is
+read from /proc).
+
+The client speaks the browser protocol of Streamlit 1.37, the version pinned
+in requirements.txt: BackMsg rerun_script with widget states and fragment_id,
+ForwardMsg deltas, ref_hash message caching, auto_rerun for polling fragments,
+and file uploads through file_urls_request plus an HTTP PUT. These are
+Streamlit internals, so the script refuses to run on any other version; update
+it together with the pin.
+
+Usage::
+
+    python benchmarks/loadtest.py                         # 1, 2, 4 and 8 guests
+    python benchmarks/loadtest.py --sessions 1,10,25 --latency 5 --json load.json
+
+Recorded with the defaults (1 s stub latency, 2 themes per guest) on Streamlit
+1.37.0, Python 3.11, a 1-CPU Linux VM (benchmarks/loadtest_results.json)::
+
+    sessions  rerun p50      p95      p99  gen p50 s  photos/min  RSS base    peak    held  MB/session
+           1      113.6    290.3    290.3       1.66        72.3       116     136     136        19.4
+           2       93.9    323.7    323.7       1.70       141.3       117     151     151        17.1
+           4      161.5    677.5    677.7       2.08       162.8       117     170     170        13.4
+           8      365.8   1266.1   1906.7       2.72       206.1       117     219     219        12.7
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.websocket import websocket_connect
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import ROOT, percentile  # noqa: E402
+
+# Streamlit release whose websocket protocol the Guest client speaks
+PROTOCOL_VERSION = "1.37"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multi-session load test for the party photo app")
+    parser.add_argument("--sessions", default="1,2,4,8", help="comma-separated concurrency levels")
+    parser.add_argument("--themes", type=int, default=2, help="pre-made themes each guest ticks")
+    parser.add_argument("--latency", type=float, default=1.0, help="stub model latency in seconds")
+    parser.add_argument("--output-edge", type=int, default=1024, help="edge of the stub's output image")
+    parser.add_argument("--photo-size", default="1600x1200", help="size of each guest's uploaded photo")
+    parser.add_argument("--think", type=float, default=0.2, help="pause between a guest's interactions, seconds")
+    parser.add_argument("--poll", type=float, default=0.5, help="PARTY_JOB_POLL_S for the server")
+    parser.add_argument("--timeout", type=float, default=300, help="per-guest time limit, seconds")
+    parser.add_argument("--json", help="write results to this JSON file")
+    return parser.parse_args()
+
+
+def rss_mb(pid):
+    """Resident set size of a process in MB, or None off Linux"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def guest_photo(index, size):
+    """JPEG bytes of a green-screen shot that differs per guest"""
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    rng = random.Random(index)
+    image = Image.new("RGB", (width, height), (30, 170, 60))
+    draw = ImageDraw.Draw(image)
+    color = (rng.randint(120, 240), rng.randint(60, 140), rng.randint(60, 200))
+    draw.ellipse((width * 0.35, height * 0.15, width * 0.65, height * 0.55), fill=color)
+    draw.rectangle((width * 0.3, height * 0.5, width * 0.7, height), fill=color[::-1])
+    from io import BytesIO
+
+    buf = BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+class Server:
+    """app.py under `streamlit run` on a free local port, with the stub model"""
+
+    def __init__(self, args):
+        self.port = free_port()
+        self.job_dir = tempfile.mkdtemp(prefix="party_loadtest_jobs_")
+        env = dict(
+            os.environ,
+            PARTY_BACKEND="stub",
+            PARTY_STUB_LATENCY_S=str(args.latency),
+            PARTY_STUB_OUTPUT_EDGE=str(args.output_edge),
+            PARTY_REQUESTS_PER_MINUTE="1000000",
+            PARTY_CACHE_DIR="",
+            PARTY_CACHE_MEMORY_MB="0",
+            PARTY_JOB_DIR=self.job_dir,
+            PARTY_JOB_POLL_S=str(args.poll),
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "streamlit", "run", os.path.join(ROOT, "app.py"),
+             "--server.port", str(self.port), "--server.headless", "true",
+             "--server.enableXsrfProtection", "false", "--server.fileWatcherType", "none",
+             "--browser.gatherUsageStats", "false"],
+            env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.base_url = f"http://127.0.0.1:{self.port}"
+
+    async def wait_ready(self, http, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                response = await http.fetch(f"{self.base_url}/_stcore/health", raise_error=False)
+                if response.code == 200:
+                    return
+            except OSError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("streamlit server did not start")
+
+    def rss_mb(self):
+        return rss_mb(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class Guest:
+    """One browser session, driven over the websocket the way the frontend does it"""
+
+    def __init__(self, server, http):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        self.server = server
+        self.http = http
+        self.finished_status = ForwardMsg.ScriptFinishedStatus
+        self.elements = {}     # delta path -> (element type, element proto, fragment id)
+        self.seen = set()      # delta paths written during the current run
+        self.states = {}       # widget id -> WidgetState sent back with every rerun
+        self.cached = {}       # hash -> cacheable ForwardMsg, to resolve ref_hash messages
+        self.fragment_run = False
+        self.auto_reruns = {}  # fragment id -> seconds, for fragments that poll (run_every)
+        self.session_id = None
+        self.file_urls = None
+        self.latencies = []    # (kind, seconds)
+
+    async def connect(self):
+        url = self.server.base_url.replace("http", "ws", 1) + "/_stcore/stream"
+        self.ws = await websocket_connect(url, subprotocols=["streamlit"], max_message_size=512 * 1024 * 1024)
+
+    def close(self):
+        self.ws.close()
+
+    async def receive(self):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        raw = await self.ws.read_message()
+        if raw is None:
+            raise ConnectionError("websocket closed")
+        msg = ForwardMsg.FromString(raw)
+        if msg.WhichOneof("type") == "ref_hash":
+            cached = self.cached.get(msg.ref_hash)
+            if cached is None:
+                response = await self.http.fetch(f"{self.server.base_url}/_stcore/message?hash={msg.ref_hash}")
+                cached = ForwardMsg.FromString(response.body)
+            cached.metadata.CopyFrom(msg.metadata)
+            msg = cached
+        elif msg.hash:
+            self.cached[msg.hash] = msg
+        self.apply(msg)
+        return msg
+
+    def apply(self, msg):
+        kind = msg.WhichOneof("type")
+        if kind == "new_session":
+            self.session_id = msg.new_session.initialize.session_id
+            self.fragment_run = bool(msg.new_session.fragment_ids_this_run)
+            self.seen = set()
+            if not self.fragment_run:
+                # Like the frontend: a full run stops every polling fragment
+                self.auto_reruns = {}
+        elif kind == "delta":
+            path = tuple(msg.metadata.delta_path)
+            self.seen.add(path)
+            if msg.delta.WhichOneof("type") == "new_element":
+                element = msg.delta.new_element
+                element_type = element.WhichOneof("type")
+                self.elements[path] = (element_type, getattr(element, element_type), msg.delta.fragment_id)
+            elif msg.delta.WhichOneof("type") == "add_block":
+                self.elements[path] = ("block", None, msg.delta.fragment_id)
+        elif kind == "script_finished":
+            # Like the frontend: a completed full run removes what it did not write
+            if msg.script_finished == self.finished_status.FINISHED_SUCCESSFULLY and not self.fragment_run:
+                self.elements = {path: e for path, e in self.elements.items() if path in self.seen}
+        elif kind == "file_urls_response":
+            self.file_urls = msg.file_urls_response
+        elif kind == "auto_rerun":
+            self.auto_reruns[msg.auto_rerun.fragment_id] = msg.auto_rerun.interval
+
+    async def wait_finished(self):
+        """Wait for the end of the current script run, and of the run it may have asked for (st.rerun)"""
+        while True:
+            msg = await self.receive()
+            if (msg.WhichOneof("type") == "script_finished"
+                    and msg.script_finished != self.finished_status.FINISHED_EARLY_FOR_RERUN):
+                return msg.script_finished
+
+    def find(self, element_type, label_prefix=""):
+        """(proto, fragment id) of the first element of a type whose label starts with label_prefix"""
+        for path in sorted(self.elements):
+            kind, proto, fragment_id = self.elements[path]
+            if kind == element_type and getattr(proto, "label", "").startswith(label_prefix):
+                return proto, fragment_id
+        return None, None
+
+    def find_all(self, element_type, label_prefix=""):
+        return [(proto, fragment_id) for kind, proto, fragment_id in (self.elements[p] for p in sorted(self.elements))
+                if kind == element_type and getattr(proto, "label", "").startswith(label_prefix)]
+
+    async def rerun(self, kind, fragment_id="", trigger=None):
+        """Send every widget state (plus a one-off trigger) and time the script run"""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+
+        msg = BackMsg()
+        msg.rerun_script.widget_states.widgets.extend(self.states.values())
+        if trigger is not None:
+            msg.rerun_script.widget_states.widgets.append(trigger)
+        msg.rerun_script.fragment_id = fragment_id
+        start = time.perf_counter()
+        await self.ws.write_message(msg.SerializeToString(), binary=True)
+        await self.wait_finished()
+        self.latencies.append((kind, time.perf_counter() - start))
+
+    async def upload(self, name, data):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        uploader, fragment_id = self.find("file_uploader")
+        msg = BackMsg()
+        msg.file_urls_request.request_id = uuid.uuid4().hex
+        msg.file_urls_request.file_names.append(name)
+        msg.file_urls_request.session_id = self.session_id
+        self.file_urls = None
+        await self.ws.write_message(msg.SerializeToString(), binary=True)
+        while self.file_urls is None:
+            await self.receive()
+        urls = self.file_urls.file_urls[0]
+
+        boundary = uuid.uuid4().hex
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{name}\"\r\n"
+                f"Content-Type: image/jpeg\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+        await self.http.fetch(self.server.base_url + urls.upload_url, method="PUT", body=body,
+                              headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+        state = WidgetState(id=uploader.id)
+        state.file_uploader_state_value.max_file_id = 1
+        info = state.file_uploader_state_value.uploaded_file_info.add(id=1, name=name, size=len(data), file_id=urls.file_id)
+        info.file_urls.CopyFrom(urls)
+        self.states[uploader.id] = state
+        await self.rerun("upload", fragment_id)
+
+    async def set_checkbox(self, label_prefix, value, kind):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        checkbox, fragment_id = self.find("checkbox", label_prefix)
+        self.states[checkbox.id] = WidgetState(id=checkbox.id, bool_value=value)
+        await self.rerun(kind, fragment_id)
+
+    async def click(self, element_type, label_prefix, kind):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        button, fragment_id = self.find(element_type, label_prefix)
+        await self.rerun(kind, fragment_id, trigger=WidgetState(id=button.id, trigger_value=True))
+        return button
+
+    async def fetch(self, url):
+        response = await self.http.fetch(self.server.base_url + url)
+        return len(response.body)
+
+
+async def run_guest(index, server, http, args, themes):
+    """One guest's visit; returns its latencies, generation time and photo count"""
+    guest = Guest(server, http)
+    await guest.connect()
+    try:
+        await guest.rerun("open")
+        await asyncio.sleep(args.think)
+        width, height = (int(v) for v in args.photo_size.split("x"))
+        await guest.upload(f"guest_{index}.jpg", guest_photo(index, (width, height)))
+        for theme in themes:
+            await asyncio.sleep(args.think)
+            await guest.set_checkbox(theme, True, "toggle_theme")
+
+        await asyncio.sleep(args.think)
+        generate_started = time.perf_counter()
+        await guest.click("button", "🎨 Generate", "generate_click")
+        # The job's progress fragment polls by itself (run_every), like the
+        # frontend rerun it on its interval until the ZIP button shows up
+        while guest.find("download_button", "📦")[0] is None:
+            if not guest.auto_reruns:
+                await guest.wait_finished()
+                continue
+            fragment_id, interval = next(iter(guest.auto_reruns.items()))
+            await asyncio.sleep(interval)
+            await guest.rerun("job_poll", fragment_id)
+        generate_seconds = time.perf_counter() - generate_started
+        downloads = guest.find_all("download_button", "📥")
+
+        # Browse: load the gallery images (display copies), download one photo, then the ZIP
+        image_bytes = 0
+        for images, _ in guest.find_all("imgs"):
+            for image in images.imgs:
+                image_bytes += await guest.fetch(image.url)
+        await asyncio.sleep(args.think)
+        button = await guest.click("download_button", "📥", "download_click")
+        download_bytes = await guest.fetch(button.url)
+        zip_button, _ = guest.find("download_button", "📦")
+        zip_bytes = await guest.fetch(zip_button.url)
+
+        await asyncio.sleep(args.think)
+        await guest.set_checkbox(themes[0], False, "toggle_with_gallery")
+        return {
+            "latencies": guest.latencies,
+            "generate_seconds": generate_seconds,
+            "generate_started": generate_started,
+            "photos": len(downloads),
+            "bytes": {"images": image_bytes, "download": download_bytes, "zip": zip_bytes},
+            "guest": guest,
+        }
+    except Exception:
+        guest.close()
+        raise
+
+
+async def run_level(count, args, themes):
+    """Run `count` guests at once against a fresh server and summarize the level"""
+    http = AsyncHTTPClient(max_clients=max(10, count * 2))
+    server = Server(args)
+    try:
+        await server.wait_ready(http)
+        # Warm-up visit, so the baseline includes the imported app and its libraries
+        warmup = Guest(server, http)
+        await warmup.connect()
+        await warmup.rerun("open")
+        warmup.close()
+        await asyncio.sleep(1.0)
+        baseline = server.rss_mb()
+
+        peak = [baseline or 0.0]
+        sampling = True
+
+        async def sample_rss():
+            while sampling:
+                rss = server.rss_mb()
+                if rss is not None:
+                    peak[0] = max(peak[0], rss)
+                await asyncio.sleep(0.1)
+
+        sampler = asyncio.ensure_future(sample_rss())
+        started = time.perf_counter()
+        visits = await asyncio.wait_for(
+            asyncio.gather(*(run_guest(i, server, http, args, themes) for i in range(count))),
+            timeout=args.timeout,
+        )
+        elapsed = time.perf_counter() - started
+        held = server.rss_mb()
+        sampling = False
+        await sampler
+        for visit in visits:
+            visit.pop("guest").close()
+    finally:
+        server.stop()
+        http.close()
+
+    latencies = [seconds for visit in visits for _, seconds in visit["latencies"]]
+    by_kind = {}
+    for visit in visits:
+        for kind, seconds in visit["latencies"]:
+            by_kind.setdefault(kind, []).append(seconds)
+    photos = sum(visit["photos"] for visit in visits)
+    generation_window = max(v["generate_started"] + v["generate_seconds"] for v in visits) - min(
+        v["generate_started"] for v in visits)
+    return {
+        "sessions": count,
+        "elapsed_s": round(elapsed, 3),
+        "rerun_ms": latency_summary(latencies),
+        "rerun_ms_by_kind": {kind: latency_summary(values) for kind, values in sorted(by_kind.items())},
+        "generate_s_p50": round(percentile([v["generate_seconds"] for v in visits], 50), 3),
+        "photos": photos,
+        "photos_per_min": round(photos / generation_window * 60, 2) if generation_window > 0 else None,
+        "rss_mb": {
+            "baseline": round(baseline, 1) if baseline else None,
+            "peak": round(peak[0], 1) if baseline else None,
+            "held": round(held, 1) if held else None,
+            "per_session": round((held - baseline) / count, 2) if baseline and held else None,
+        },
+        "bytes_per_session": {
+            key: sum(v["bytes"][key] for v in visits) // count for key in ("images", "download", "zip")
+        },
+    }
+
+
+def latency_summary(samples):
+    return {
+        "n": len(samples),
+        "p50": round(percentile(samples, 50) * 1000, 1),
+        "p95": round(percentile(samples, 95) * 1000, 1),
+        "p99": round(percentile(samples, 99) * 1000, 1),
+    }
+
+
+def print_report(levels):
+    print(f"{'sessions':>8} {'rerun p50':>10} {'p95':>8} {'p99':>8} {'gen p50 s':>10} {'photos/min':>11} "
+          f"{'RSS base':>9} {'peak':>7} {'held':>7} {'MB/session':>11}")
+    for level in levels:
+        rerun, rss = level["rerun_ms"], level["rss_mb"]
+        fmt = lambda v, spec: format(v, spec) if v is not None else "n/a"
+        print(f"{level['sessions']:>8} {rerun['p50']:>10.1f} {rerun['p95']:>8.1f} {rerun['p99']:>8.1f} "
+              f"{level['generate_s_p50']:>10.2f} {fmt(level['photos_per_min'], '>11.1f')} "
+              f"{fmt(rss['baseline'], '>9.0f')} {fmt(rss['peak'], '>7.0f')} {fmt(rss['held'], '>7.0f')} "
+              f"{fmt(rss['per_session'], '>11.1f')}")
+    print()
+    print("rerun latency by interaction, ms (p50 / p95):")
+    kinds = sorted({kind for level in levels for kind in level["rerun_ms_by_kind"]})
+    print(f"{'sessions':>8} " + " ".join(f"{kind:>22}" for kind in kinds))
+    for level in levels:
+        cells = []
+        for kind in kinds:
+            stats = level["rerun_ms_by_kind"].get(kind)
+            cells.append(f"{stats['p50']:>10.1f} / {stats['p95']:>9.1f}" if stats else f"{'':>22}")
+        print(f"{level['sessions']:>8} " + " ".join(cells))
+
+
+async def run(args):
+    sys.path.insert(0, ROOT)
+    import app
+
+    themes = list(app.PREDEFINED_PROMPTS.values())[:max(1, args.themes)]
+    levels = []
+    for count in (int(n) for n in args.sessions.split(",") if n):
+        print(f"🍌 {count} sessions...", file=sys.stderr)
+        levels.append(await run_level(count, args, themes))
+    return levels
+
+
+def main():
+    import streamlit
+
+    args = parse_args()
+    if not streamlit.__version__.startswith(PROTOCOL_VERSION + "."):
+        print(f"❌ This load test speaks the Streamlit {PROTOCOL_VERSION} protocol, found {streamlit.__version__}",
+              file=sys.stderr)
+        return 2
+    levels = asyncio.run(run(args))
+    print_report(levels)
+    if args.json:
+        meta = {"streamlit": streamlit.__version__, "python": platform.python_version(), "cpus": os.cpu_count(),
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with open(args.json, "w") as f:
+            json.dump({"meta": meta, "args": vars(args), "levels": levels}, f, indent=2)
+            f.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""Bounded, session-scoped storage for encoded photo bytes.
+
+Browser sessions keep only blob ids in their session state; the bytes live in
+one process-wide BlobStore:
+
+* blobs stay in RAM until the process-wide ``memory_bytes`` budget is used,
+  then the least recently used ones are spilled to files in ``spill_dir``
+* each session may hold at most ``session_quota`` bytes and the whole process
+  ``global_quota`` bytes (RAM + disk); going over evicts least recently used
+  blobs, after which ``get`` returns None for them
+* a session's blobs are dropped when its BlobSession handle is garbage
+  collected (i.e. when Streamlit discards the session state holding it) or
+  when the session has been idle for ``idle_ttl_seconds``
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+
+
+class BlobStore:
+    """Encoded bytes grouped by session, with LRU spilling and eviction"""
+
+    def __init__(self, memory_bytes=256 * 1024 * 1024, session_quota=64 * 1024 * 1024,
+                 global_quota=2048 * 1024 * 1024, spill_dir=None, idle_ttl_seconds=2 * 3600):
+        self.memory_bytes = memory_bytes
+        self.session_quota = session_quota
+        self.global_quota = global_quota
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.spill_dir = tempfile.mkdtemp(prefix="nano_banana_blobs_", dir=spill_dir)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+        self._lock = threading.Lock()
+        # blob id -> {"session", "size", "data" (bytes or None), "path" (str or None)}
+        self._blobs = OrderedDict()
+        self._sessions = {}
+        self._memory_used = 0
+        self._total_used = 0
+        self.stats = {"spilled": 0, "evicted": 0}
+
+    def open_session(self, session_id):
+        """Handle for one browser session; its blobs go away with the handle"""
+        return BlobSession(self, session_id)
+
+    def put(self, session_id, data):
+        """Store bytes for a session and return the new blob id"""
+        blob_id = uuid.uuid4().hex
+        size = len(data)
+        with self._lock:
+            self._touch_session(session_id)
+            self._blobs[blob_id] = {"session": session_id, "size": size, "data": data, "path": None}
+            self._sessions[session_id]["bytes"] += size
+            self._memory_used += size
+            self._total_used += size
+            self._enforce_quotas(session_id)
+            self._spill_to_fit()
+            self._drop_idle_sessions()
+        return blob_id
+
+    def get(self, blob_id):
+        """Bytes of a blob, or None if it was evicted or deleted"""
+        with self._lock:
+            blob = self._blobs.get(blob_id)
+            if blob is None:
+                return None
+            self._blobs.move_to_end(blob_id)
+            self._touch_session(blob["session"])
+            if blob["data"] is not None:
+                return blob["data"]
+            path = blob["path"]
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def session_of(self, blob_id):
+        with self._lock:
+            blob = self._blobs.get(blob_id)
+            return blob["session"] if blob else None
+
+    def delete(self, blob_id):
+        with self._lock:
+            self._remove(blob_id)
+
+    def drop_session(self, session_id):
+        """Forget every blob of a session"""
+        with self._lock:
+            for blob_id in [b for b, blob in self._blobs.items() if blob["session"] == session_id]:
+                self._remove(blob_id)
+            self._sessions.pop(session_id, None)
+
+    def __contains__(self, blob_id):
+        with self._lock:
+            return blob_id in self._blobs
+
+    def summary(self):
+        """Short human-readable usage counters"""
+        with self._lock:
+            memory_mb = self._memory_used / (1024 * 1024)
+            disk_mb = (self._total_used - self._memory_used) / (1024 * 1024)
+            sessions, blobs = len(self._sessions), len(self._blobs)
+            stats = dict(self.stats)
+        return (f"{blobs} photos for {sessions} sessions, {memory_mb:.1f} MB in memory, "
+                f"{disk_mb:.1f} MB spilled to disk, {stats['evicted']} evicted")
+
+    # Callers below hold self._lock
+
+    def _touch_session(self, session_id):
+        session = self._sessions.setdefault(session_id, {"bytes": 0, "seen": 0.0})
+        session["seen"] = time.monotonic()
+
+    def _remove(self, blob_id):
+        blob = self._blobs.pop(blob_id, None)
+        if blob is None:
+            return
+        self._total_used -= blob["size"]
+        if blob["data"] is not None:
+            self._memory_used -= blob["size"]
+        if blob["path"] is not None:
+            try:
+                os.remove(blob["path"])
+            except OSError:
+                pass
+        session = self._sessions.get(blob["session"])
+        if session is not None:
+            session["bytes"] -= blob["size"]
+
+    def _enforce_quotas(self, session_id):
+        # Oldest blobs of this session first, then oldest blobs overall; the
+        # newest blob is always kept so a single large photo still works
+        newest = next(reversed(self._blobs))
+        for blob_id in [b for b, blob in self._blobs.items() if blob["session"] == session_id]:
+            if self._sessions[session_id]["bytes"] <= self.session_quota or blob_id == newest:
+                break
+            self._remove(blob_id)
+            self.stats["evicted"] += 1
+        for blob_id in list(self._blobs):
+            if self._total_used <= self.global_quota or blob_id == newest:
+                break
+            self._remove(blob_id)
+            self.stats["evicted"] += 1
+
+    def _spill_to_fit(self):
+        for blob_id, blob in self._blobs.items():
+            if self._memory_used <= self.memory_bytes:
+                break
+            if blob["data"] is None:
+                continue
+            path = os.path.join(self.spill_dir, blob_id)
+            try:
+                with open(path, "wb") as f:
+                    f.write(blob["data"])
+            except OSError:
+                continue
+            blob["path"], blob["data"] = path, None
+            self._memory_used -= blob["size"]
+            self.stats["spilled"] += 1
+
+    def _drop_idle_sessions(self):
+        cutoff = time.monotonic() - self.idle_ttl_seconds
+        idle = {sid for sid, session in self._sessions.items() if session["seen"] < cutoff}
+        if idle:
+            for blob_id in [b for b, blob in self._blobs.items() if blob["session"] in idle]:
+                self._remove(blob_id)
+            for session_id in idle:
+                self._sessions.pop(session_id, None)
+
+
+class BlobSession:
+    """A browser session's view of the store (keep it in the session state)"""
+
+    def __init__(self, store, session_id):
+        self.store = store
+        self.session_id = session_id
+        weakref.finalize(self, store.drop_session, session_id)
+
+    def put(self, data):
+        return self.store.put(self.session_id, data)
+
+    def get(self, blob_id):
+        return self.store.get(blob_id)
+
+    def delete(self, blob_id):
+        self.store.delete(blob_id)
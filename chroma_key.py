@@ -0,0 +1,144 @@
+"""Local chroma key for green-screen photos, vectorized with NumPy.
+
+analyze() keys a photo at preview resolution (a few tens of milliseconds) and
+scores how cleanly it keys, so a guest can fix the lighting before spending a
+model call:
+
+* the key colour is the median of the clearly green pixels
+* alpha comes from each pixel's distance to the key in rg chromaticity
+  (r / (r + g + b), g / (r + g + b)), which shadows on the screen hardly
+  change; very dark pixels (hair, black clothes) always count as foreground
+* the score (0-100) starts at 100 and loses points for little visible screen,
+  unevenly lit screen, wide soft edges and green spill on the person
+
+prekey() applies the same key at full resolution and puts the (despilled)
+person on a flat, evenly lit green, which the model removes more reliably than
+a wrinkled or shadowed screen.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+PREVIEW_EDGE = 512
+FLAT_GREEN = (0, 177, 64)
+
+# Chromaticity distance from the key: below INNER is screen, above OUTER is subject
+INNER = 0.05
+OUTER = 0.12
+# Brightness (max of R, G, B) below which a pixel is never keyed out
+DARK = 0.12
+
+KeyResult = namedtuple(
+    "KeyResult", ["alpha", "score", "coverage", "unevenness", "fuzz", "spill", "key_color", "issues"]
+)
+
+
+def _greenness(rgb):
+    return rgb[..., 1] - np.maximum(rgb[..., 0], rgb[..., 2])
+
+
+def _to_array(image):
+    return np.asarray(image.convert("RGB") if image.mode != "RGB" else image, dtype=np.float32) / 255.0
+
+
+def find_key_color(rgb):
+    """Median colour (0-1 floats) of the clearly green pixels, or None if there are too few"""
+    green = _greenness(rgb) > 0.12
+    if green.mean() < 0.01:
+        return None
+    return np.median(rgb[green], axis=0)
+
+
+def compute_alpha(rgb, key_color):
+    """Foreground alpha (0 = screen, 1 = subject) for an H x W x 3 float array"""
+    key_r, key_g = key_color[:2] / (key_color.sum() + 1e-6)
+    total = rgb.sum(axis=-1)
+    total += 1e-6
+    dr = rgb[..., 0] / total
+    dr -= key_r
+    dg = rgb[..., 1] / total
+    dg -= key_g
+    distance = np.sqrt(dr * dr + dg * dg)
+    alpha = np.clip((distance - INNER) * (1.0 / (OUTER - INNER)), 0.0, 1.0, out=distance)
+    alpha[rgb.max(axis=-1) < DARK] = 1.0
+    return alpha
+
+
+def _shrink(image, max_edge):
+    # reduce() (a box filter) is much faster than a full resample and fine for a preview
+    factor = -(-max(image.size) // max_edge)
+    return image.reduce(factor) if factor > 1 else image
+
+
+def analyze(image, max_edge=PREVIEW_EDGE):
+    """Key a PIL image at preview resolution and score the result (see module docstring)"""
+    rgb = _to_array(_shrink(image, max_edge))
+
+    key_color = find_key_color(rgb)
+    if key_color is None:
+        alpha = np.ones(rgb.shape[:2], dtype=np.float32)
+        return KeyResult(alpha, 0, 0.0, 0.0, 0.0, 0.0, None, ["🔍 no green screen found behind the person"])
+    alpha = compute_alpha(rgb, key_color)
+
+    screen = alpha < 0.05
+    subject = alpha > 0.95
+    coverage = float(screen.mean())
+    fuzz = float(1.0 - coverage - subject.mean())
+    # Spread of the screen's brightness: shadows, hotspots and gradients
+    brightness = rgb.max(axis=-1)[screen]
+    unevenness = float(brightness.std() / (brightness.mean() + 1e-6)) if brightness.size else 0.0
+    # Share of the person that picked up a green cast from the screen
+    spill = float((_greenness(rgb)[subject] > 0.05).mean()) if subject.any() else 0.0
+
+    score, issues = 100.0, []
+    if coverage < 0.15:
+        score *= coverage / 0.15
+        issues.append("🔍 very little green screen is visible")
+    if unevenness > 0.12:
+        score -= 40 * min(1.0, (unevenness - 0.08) / 0.3)
+        issues.append("🌗 the green screen is unevenly lit (shadows or bright spots)")
+    if fuzz > 0.04:
+        score -= 30 * min(1.0, (fuzz - 0.02) / 0.10)
+        issues.append("🌫️ soft or noisy edges between the person and the screen")
+    if spill > 0.05:
+        score -= 30 * min(1.0, (spill - 0.02) / 0.15)
+        issues.append("🟢 green light is reflecting onto the person")
+    score = int(round(max(0.0, min(100.0, score))))
+    return KeyResult(alpha, score, coverage, unevenness, fuzz, spill, key_color, issues)
+
+
+def _despill(rgb):
+    # Standard green despill: green never exceeds the brighter of red and blue
+    out = rgb.copy()
+    out[..., 1] = np.minimum(rgb[..., 1], np.maximum(rgb[..., 0], rgb[..., 2]))
+    return out
+
+
+def preview(image, result, max_edge=PREVIEW_EDGE):
+    """The keyed person over a checkerboard (pass the max_edge given to analyze())"""
+    rgb = _despill(_to_array(_shrink(image, max_edge)))
+    height, width = result.alpha.shape
+    yy, xx = np.indices((height, width))
+    checker = np.where(((yy // 16 + xx // 16) % 2 == 0)[..., None], 0.8, 0.6).astype(np.float32)
+    alpha = result.alpha[..., None]
+    out = rgb * alpha + checker * (1.0 - alpha)
+    return Image.fromarray((out * 255.0 + 0.5).astype(np.uint8), "RGB")
+
+
+def prekey(image, key_color=None, background=FLAT_GREEN):
+    """Full-resolution copy of a photo with its screen replaced by a flat green
+
+    key_color may come from an analyze() result to skip estimating it again.
+    Returns None when no green screen is found.
+    """
+    rgb = _to_array(image)
+    if key_color is None:
+        key_color = find_key_color(rgb)
+        if key_color is None:
+            return None
+    alpha = compute_alpha(rgb, key_color)[..., None]
+    flat = np.asarray(background, dtype=np.float32) / 255.0
+    out = _despill(rgb) * alpha + flat * (1.0 - alpha)
+    return Image.fromarray((out * 255.0 + 0.5).astype(np.uint8), "RGB")
@@ -0,0 +1,157 @@
+"""Process-wide governor for Gemini requests.
+
+Every call to the model goes through one RequestGovernor shared by all
+sessions, which
+
+* spaces requests with a token bucket (requests per minute, 0 for no limit),
+* caps the number of requests in flight, halving the cap on 429s and growing
+  it back by one slot per cap's worth of successes,
+* retries quota, 5xx and timeout errors with exponential backoff and full
+  jitter, waiting at least as long as the server's retry hint, and pausing
+  every caller (not just the one that was throttled) while that hint runs.
+"""
+
+import random
+import re
+import threading
+import time
+
+import httpx
+from google.genai import errors
+
+RETRIABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def retry_hint_seconds(exc):
+    """Server-suggested wait from a Retry-After header or a RetryInfo detail, if any"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+
+    details = getattr(exc, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []) or []:
+            if str(detail.get("@type", "")).endswith("RetryInfo"):
+                match = re.match(r"^([\d.]+)s$", str(detail.get("retryDelay", "")))
+                if match:
+                    return float(match.group(1))
+    return None
+
+
+def is_retriable(exc):
+    """Whether a failed request is worth retrying"""
+    if isinstance(exc, errors.APIError):
+        return exc.code in RETRIABLE_STATUS_CODES
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError))
+
+
+def is_throttled(exc):
+    return isinstance(exc, errors.APIError) and exc.code == 429
+
+
+class RequestGovernor:
+    """Rate limit, concurrency limit and retry policy shared by all callers"""
+
+    def __init__(self, requests_per_minute=60, max_concurrency=8, min_concurrency=1,
+                 max_retries=4, base_delay=2.0, max_delay=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._capacity = float(max(1, min(requests_per_minute, max_concurrency)))
+        self._tokens = self._capacity
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0}
+
+    @property
+    def concurrency_limit(self):
+        """Current (adaptive) number of requests allowed in flight"""
+        with self._cond:
+            return int(self._limit)
+
+    @property
+    def in_flight(self):
+        with self._cond:
+            return self._in_flight
+
+    def call(self, request, on_retry=None):
+        """Run request() under the governor, retrying transient failures.
+
+        on_retry(attempt, delay_seconds, exc) is called before each retry wait.
+        Non-retriable errors, and the last error once retries run out, are raised.
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                result = request()
+            except Exception as exc:
+                self._release(success=False, throttled=is_throttled(exc))
+                if not is_retriable(exc) or attempt >= self.max_retries:
+                    with self._cond:
+                        self.stats["failures"] += 1
+                    raise
+                attempt += 1
+                delay = self._backoff(attempt, exc)
+                with self._cond:
+                    self.stats["retries"] += 1
+                if on_retry is not None:
+                    on_retry(attempt, delay, exc)
+                time.sleep(delay)
+            else:
+                self._release(success=True, throttled=False)
+                return result
+
+    def _backoff(self, attempt, exc):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = retry_hint_seconds(exc)
+        if hint is not None:
+            delay = max(delay, hint + random.uniform(0, 1))
+            # Everyone waits out the server's hint, not just this caller
+            with self._cond:
+                self._paused_until = max(self._paused_until, time.monotonic() + hint)
+        return delay
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                limited = self.requests_per_minute > 0
+                if wait <= 0 and self._in_flight < int(self._limit) and (not limited or self._tokens >= 1):
+                    if limited:
+                        self._tokens -= 1
+                    self._in_flight += 1
+                    self.stats["requests"] += 1
+                    return
+                if wait <= 0 and limited and self._tokens < 1:
+                    wait = (1 - self._tokens) * 60.0 / self.requests_per_minute
+                # Woken early when a slot frees up; otherwise re-check after the wait
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def _release(self, success, throttled):
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.stats["throttled"] += 1
+                self._limit = max(float(self.min_concurrency), self._limit / 2)
+            elif success:
+                self._limit = min(float(self.max_concurrency), self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._tokens = min(self._capacity, self._tokens + elapsed * self.requests_per_minute / 60.0)
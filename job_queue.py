@@ -0,0 +1,356 @@
+"""Persistent queue of party photo jobs, shared by every app process on a host.
+
+A job is one source photo plus a list of prompts; it is keyed by a hash of the
+photo, the prompts and the model, so submitting the same work again (a rerun,
+a reconnecting phone, another guest) finds the existing job instead of paying
+for it twice. Each prompt is a task that any worker can claim:
+
+* the queue is a SQLite database (WAL mode) in ``directory``, next to the
+  source photos and result files the workers read and write
+* workers claim a task with a lease, which they renew while they work on it;
+  if a worker dies, its task is handed to another worker once the lease runs
+  out (up to ``max_attempts`` times)
+* workers are threads started with ``start_workers``, in the Streamlit
+  processes and/or in standalone ``worker.py`` processes
+* finished jobs are deleted after ``max_age_seconds``
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    source_digest TEXT NOT NULL,
+    source_mime TEXT NOT NULL,
+    variants INTEGER NOT NULL DEFAULT 1,
+    session TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    prompt_name TEXT NOT NULL,
+    prompt_description TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    leased_until REAL,
+    finished REAL,
+    result TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS tasks_by_status ON tasks (status, leased_until);
+"""
+
+_PRUNE_INTERVAL_SECONDS = 300
+
+
+def job_key(source_digest, prompts, model, variants=1):
+    """Job id for a source photo (source_digest), a list of (name, description) prompts, a model
+    and the number of variants per prompt"""
+    hasher = hashlib.sha256()
+    for field in (model, source_digest, json.dumps(list(prompts), ensure_ascii=False), str(variants)):
+        hasher.update(field.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class JobQueue:
+    """SQLite-backed queue of generation tasks with leases and file-backed results.
+
+    A task's result is ``(photos, messages)``: photos are dicts with "data",
+    "mime_type", "file_name" and "prompt_name"; messages are (level, text) pairs.
+    """
+
+    def __init__(self, directory, lease_seconds=600, max_attempts=3, max_age_seconds=24 * 3600):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_age_seconds = max_age_seconds
+        self.path = os.path.join(directory, "jobs.sqlite3")
+        os.makedirs(os.path.join(directory, "sources"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "results"), exist_ok=True)
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+            # Queues created before variants and sessions existed
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+            if "variants" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN variants INTEGER NOT NULL DEFAULT 1")
+            if "session" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN session TEXT")
+        # Wakes this process's idle workers when a job is submitted here; workers
+        # in other processes notice new tasks on their next poll
+        self._wakeup = threading.Condition()
+        self._pruned_at = 0.0
+
+    def submit(self, source_data, source_mime, prompts, model, variants=1, session=None):
+        """Queue a job (or find the existing one) and return its id.
+
+        Resubmitting a job queues its failed prompts again. ``session`` names the
+        browser session that asked for the job (handed to workers with each task,
+        for tagging); a job found again keeps the session that first submitted it.
+        """
+        prompts = [(name, description) for name, description in prompts]
+        source_digest = hashlib.sha256(source_data).hexdigest()
+        job_id = job_key(source_digest, prompts, model, variants)
+        source_path = self._source_path(source_digest)
+        if os.path.exists(source_path):
+            # Fresh mtime: a concurrent prune leaves it alone until the job is inserted
+            os.utime(source_path)
+        else:
+            _write_atomic(source_path, source_data)
+
+        now = time.time()
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone():
+                db.execute("UPDATE jobs SET updated = ? WHERE id = ?", (now, job_id))
+                db.execute(
+                    "UPDATE tasks SET status = 'queued', attempts = 0, worker = NULL, leased_until = NULL "
+                    "WHERE job_id = ? AND status = 'failed'",
+                    (job_id,),
+                )
+            else:
+                db.execute(
+                    "INSERT INTO jobs (id, source_digest, source_mime, variants, session, created, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, source_digest, source_mime, variants, session, now, now),
+                )
+                db.executemany(
+                    "INSERT INTO tasks (job_id, idx, prompt_name, prompt_description, status) VALUES (?, ?, ?, ?, 'queued')",
+                    [(job_id, index, name, description) for index, (name, description) in enumerate(prompts)],
+                )
+        with self._wakeup:
+            self._wakeup.notify_all()
+        self._maybe_prune()
+        return job_id
+
+    def claim(self, worker_id):
+        """Lease the oldest waiting task to a worker; returns the task dict or None"""
+        now = time.time()
+        with self._transaction() as db:
+            while True:
+                row = db.execute(
+                    "SELECT t.job_id, t.idx, t.prompt_name, t.prompt_description, t.attempts, "
+                    "j.source_digest, j.source_mime, j.variants, j.session FROM tasks t JOIN jobs j ON j.id = t.job_id "
+                    "WHERE t.status = 'queued' OR (t.status = 'running' AND t.leased_until < ?) "
+                    "ORDER BY j.created, t.idx LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["attempts"] >= self.max_attempts:
+                    # Its workers kept dying (or timing out) on it: give up
+                    result = {"photos": [], "messages": [("error", f"❌ Gave up on {row['prompt_name']} after {row['attempts']} attempts")]}
+                    db.execute(
+                        "UPDATE tasks SET status = 'failed', finished = ?, result = ? WHERE job_id = ? AND idx = ?",
+                        (now, json.dumps(result, ensure_ascii=False), row["job_id"], row["idx"]),
+                    )
+                    continue
+                db.execute(
+                    "UPDATE tasks SET status = 'running', worker = ?, leased_until = ?, attempts = attempts + 1 "
+                    "WHERE job_id = ? AND idx = ?",
+                    (worker_id, now + self.lease_seconds, row["job_id"], row["idx"]),
+                )
+                return {
+                    "job_id": row["job_id"],
+                    "index": row["idx"],
+                    "prompt_name": row["prompt_name"],
+                    "prompt_description": row["prompt_description"],
+                    "source_digest": row["source_digest"],
+                    "source_mime": row["source_mime"],
+                    "variants": row["variants"],
+                    "session": row["session"],
+                }
+
+    def renew(self, task, worker_id):
+        """Extend the lease of a task this worker is still running; False if it lost the task"""
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE tasks SET leased_until = ? WHERE job_id = ? AND idx = ? AND status = 'running' AND worker = ?",
+                (time.time() + self.lease_seconds, task["job_id"], task["index"], worker_id),
+            )
+            return cursor.rowcount > 0
+
+    def read_source(self, task):
+        """Encoded bytes of a task's source photo"""
+        with open(self._source_path(task["source_digest"]), "rb") as f:
+            return f.read()
+
+    def complete(self, task, photos, messages):
+        """Store a task's result; a prompt that produced no photo counts as failed"""
+        result_dir = os.path.join(self.directory, "results", task["job_id"])
+        os.makedirs(result_dir, exist_ok=True)
+        stored = []
+        for j, photo in enumerate(photos):
+            file_name = f"{task['index']}.{j}.bin"
+            _write_atomic(os.path.join(result_dir, file_name), photo["data"])
+            stored.append({
+                "file": file_name,
+                "mime_type": photo["mime_type"],
+                "file_name": photo["file_name"],
+                "prompt_name": photo["prompt_name"],
+            })
+        result = {"photos": stored, "messages": [list(message) for message in messages]}
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = ?, finished = ?, leased_until = NULL, result = ? "
+                "WHERE job_id = ? AND idx = ? AND status != 'done'",
+                ("done" if photos else "failed", time.time(), json.dumps(result, ensure_ascii=False), task["job_id"], task["index"]),
+            )
+
+    def status(self, job_id):
+        """Progress of a job, or None if it does not exist (any more)"""
+        with self._connection() as db:
+            job = db.execute("SELECT created, updated FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            rows = db.execute(
+                "SELECT idx, prompt_name, status, finished FROM tasks WHERE job_id = ? ORDER BY idx",
+                (job_id,),
+            ).fetchall()
+        tasks = [{"index": row["idx"], "prompt_name": row["prompt_name"], "status": row["status"]} for row in rows]
+        finished = [row["finished"] for row in rows if row["status"] in ("done", "failed")]
+        return {
+            "tasks": tasks,
+            "total": len(tasks),
+            "done": sum(1 for task in tasks if task["status"] == "done"),
+            "failed": sum(1 for task in tasks if task["status"] == "failed"),
+            "finished": len(finished) == len(tasks),
+            "seconds": (max(finished) - job["updated"]) if finished and len(finished) == len(tasks) else None,
+        }
+
+    def results(self, job_id, index):
+        """(photos, messages) of a finished task; photos that were pruned meanwhile are skipped"""
+        with self._connection() as db:
+            row = db.execute("SELECT result FROM tasks WHERE job_id = ? AND idx = ?", (job_id, index)).fetchone()
+        if row is None or row["result"] is None:
+            return [], []
+        result = json.loads(row["result"])
+        photos = []
+        for photo in result["photos"]:
+            try:
+                with open(os.path.join(self.directory, "results", job_id, photo.pop("file")), "rb") as f:
+                    photos.append({"data": f.read(), **photo})
+            except OSError:
+                continue
+        return photos, [tuple(message) for message in result["messages"]]
+
+    def start_workers(self, handler, count, name="party-job", poll_seconds=1.0):
+        """Start count daemon threads that claim tasks and run handler(task) -> (photos, messages)"""
+        threads = []
+        for n in range(count):
+            thread = threading.Thread(
+                target=self._work, args=(handler, poll_seconds), name=f"{name}-{n}", daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _work(self, handler, poll_seconds):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        while True:
+            try:
+                task = self.claim(worker_id)
+            except sqlite3.Error:
+                task = None
+            if task is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=poll_seconds)
+                continue
+            try:
+                # A task can outlast its lease (retries, backoff, variant calls):
+                # renew it so no other worker pays for the same prompt again
+                with self._renewing(task, worker_id):
+                    photos, messages = handler(task)
+            except Exception as e:
+                photos, messages = [], [("error", f"❌ Error creating {task['prompt_name']} photo: {str(e)}")]
+            try:
+                self.complete(task, photos, messages)
+            except (OSError, sqlite3.Error):
+                # The lease runs out and another worker retries the task
+                pass
+
+    @contextmanager
+    def _renewing(self, task, worker_id):
+        done = threading.Event()
+
+        def renew_until_done():
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    if not self.renew(task, worker_id):
+                        return
+                except sqlite3.Error:
+                    pass
+
+        thread = threading.Thread(target=renew_until_done, name=f"{threading.current_thread().name}-lease", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def _source_path(self, source_digest):
+        return os.path.join(self.directory, "sources", f"{source_digest}.bin")
+
+    def _maybe_prune(self):
+        now = time.time()
+        if now - self._pruned_at < _PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned_at = now
+        cutoff = now - self.max_age_seconds
+        with self._transaction() as db:
+            expired = [row["id"] for row in db.execute("SELECT id FROM jobs WHERE updated < ?", (cutoff,))]
+            for job_id in expired:
+                db.execute("DELETE FROM tasks WHERE job_id = ?", (job_id,))
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            live_sources = {row["source_digest"] for row in db.execute("SELECT source_digest FROM jobs")}
+        for job_id in expired:
+            shutil.rmtree(os.path.join(self.directory, "results", job_id), ignore_errors=True)
+        for name in os.listdir(os.path.join(self.directory, "sources")):
+            path = os.path.join(self.directory, "sources", name)
+            try:
+                # Recent files may belong to a job another process is submitting
+                if name[:-4] not in live_sources and os.path.getmtime(path) < now - _PRUNE_INTERVAL_SECONDS:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @contextmanager
+    def _connection(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes cannot
+        # claim the same task
+        with self._connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,219 @@
+"""Per-stage timing for the party photo pipeline.
+
+Wrap a stage with ``metrics.timer("stage")`` (or call ``metrics.record``). Each
+measurement is tagged with the thread's current tags (``metrics.tags(session=...,
+prompt=...)``) and feeds:
+
+* rolling p50/p95 per stage for the sidebar ops panel (``metrics.summary()``)
+* a JSON-lines log (PARTY_METRICS_LOG=path)
+* Prometheus text, written to PARTY_METRICS_PROM_FILE and/or served on
+  http://0.0.0.0:PARTY_METRICS_PORT/metrics
+
+Recording is on when PARTY_METRICS=1 or any of the outputs above (or the ops
+panel, PARTY_OPS_PANEL=1) is configured. When it is off, timer() hands back a
+shared no-op context manager, so instrumented code pays one attribute lookup.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOG_PATH = os.environ.get("PARTY_METRICS_LOG") or None
+PROM_FILE = os.environ.get("PARTY_METRICS_PROM_FILE") or None
+PROM_PORT = int(os.environ.get("PARTY_METRICS_PORT", "0"))
+OPS_PANEL = os.environ.get("PARTY_OPS_PANEL", "0") == "1"
+WINDOW = int(os.environ.get("PARTY_METRICS_WINDOW", "500"))
+PROM_FILE_INTERVAL_S = 5.0
+
+enabled = (
+    os.environ.get("PARTY_METRICS", "0") == "1"
+    or bool(LOG_PATH or PROM_FILE or PROM_PORT or OPS_PANEL)
+)
+
+_lock = threading.Lock()
+_local = threading.local()
+_samples = {}
+_totals = {}
+_gauges = {}
+_log_file = None
+_prom_written_at = 0.0
+_server = None
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, stage, tags):
+        self.stage = stage
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, time.perf_counter() - self.start, **self.tags)
+        return False
+
+
+def timer(stage, **tags):
+    """Context manager timing one run of a stage"""
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(stage, tags)
+
+
+@contextmanager
+def tags(**values):
+    """Tag every measurement made on this thread inside the block"""
+    previous = getattr(_local, "tags", {})
+    _local.tags = {**previous, **values}
+    try:
+        yield
+    finally:
+        _local.tags = previous
+
+
+def set_tags(**values):
+    """Replace the tags attached to measurements made on this thread"""
+    _local.tags = dict(values)
+
+
+def current_tags():
+    """Tags of this thread (to hand over to worker threads)"""
+    return dict(getattr(_local, "tags", {}))
+
+
+def record(stage, seconds, **extra_tags):
+    """Record one measurement of a stage"""
+    if not enabled:
+        return
+    entry_tags = {**getattr(_local, "tags", {}), **extra_tags}
+    with _lock:
+        _samples.setdefault(stage, deque(maxlen=WINDOW)).append(seconds)
+        count, total = _totals.get(stage, (0, 0.0))
+        _totals[stage] = (count + 1, total + seconds)
+        if LOG_PATH:
+            _write_log({"ts": round(time.time(), 3), "stage": stage, "seconds": round(seconds, 6), **entry_tags})
+    if PROM_FILE:
+        _maybe_write_prom_file()
+
+
+def gauge_add(name, delta):
+    """Move a gauge (e.g. requests in flight) up or down"""
+    if not enabled:
+        return
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + delta
+
+
+def gauges():
+    with _lock:
+        return dict(_gauges)
+
+
+def summary():
+    """Per-stage count, p50 and p95 (seconds, over the rolling window)"""
+    with _lock:
+        snapshot = {stage: sorted(values) for stage, values in _samples.items()}
+        totals = dict(_totals)
+    return {
+        stage: {
+            "count": totals[stage][0],
+            "p50": _quantile(values, 0.5),
+            "p95": _quantile(values, 0.95),
+        }
+        for stage, values in snapshot.items()
+    }
+
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format"""
+    lines = [
+        "# HELP party_stage_seconds Time spent in each party photo pipeline stage",
+        "# TYPE party_stage_seconds summary",
+    ]
+    with _lock:
+        snapshot = {stage: sorted(values) for stage, values in _samples.items()}
+        totals = dict(_totals)
+        current_gauges = dict(_gauges)
+    for stage in sorted(snapshot):
+        for q in (0.5, 0.95):
+            lines.append(f'party_stage_seconds{{stage="{stage}",quantile="{q}"}} {_quantile(snapshot[stage], q):.6f}')
+        count, total = totals[stage]
+        lines.append(f'party_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'party_stage_seconds_count{{stage="{stage}"}} {count}')
+    for name in sorted(current_gauges):
+        lines.append(f"# TYPE party_{name} gauge")
+        lines.append(f"party_{name} {current_gauges[name]}")
+    return "\n".join(lines) + "\n"
+
+
+def start_server(port=None):
+    """Serve /metrics on a background thread (once per process)"""
+    global _server
+    port = port or PROM_PORT
+    with _lock:
+        if _server is not None or not port:
+            return _server
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        _server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="party-metrics", daemon=True).start()
+        return _server
+
+
+def _quantile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _write_log(entry):
+    # Caller holds _lock
+    global _log_file
+    if _log_file is None:
+        _log_file = open(LOG_PATH, "a", encoding="utf-8")
+    _log_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    _log_file.flush()
+
+
+def _maybe_write_prom_file():
+    global _prom_written_at
+    now = time.monotonic()
+    with _lock:
+        if now - _prom_written_at < PROM_FILE_INTERVAL_S:
+            return
+        _prom_written_at = now
+    tmp_path = f"{PROM_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, PROM_FILE)
@@ -0,0 +1,105 @@
+"""Output encoding presets for party photos.
+
+A preset fixes the format and encoder settings of the photos guests download
+(one by one or as a ZIP):
+
+* original: the stored bytes, as the model returned them (no re-encode)
+* share:    progressive JPEG, quality 85, 4:2:0 chroma, at most 2048 px (a large
+            JPEG may come out up to 10% smaller, see draft); small and quick
+            to send to phones
+* archive:  progressive JPEG, quality 95, 4:4:4 chroma, full size
+* webp:     WebP, quality 85, full size
+* png:      lossless PNG, full size
+
+Pillow releases the GIL while it encodes, so several encode_bytes calls run in
+parallel on a plain thread pool.
+"""
+
+import io
+from collections import namedtuple
+
+from PIL import Image
+
+EncoderPreset = namedtuple(
+    "EncoderPreset", ["name", "label", "format", "quality", "progressive", "subsampling", "max_edge"]
+)
+
+PRESETS = {
+    "original": EncoderPreset("original", "📄 Original (as generated)", None, None, False, None, None),
+    "share": EncoderPreset("share", "📱 Share (small JPEG)", "JPEG", 85, True, "4:2:0", 2048),
+    "archive": EncoderPreset("archive", "🗄️ Archive (best JPEG)", "JPEG", 95, True, "4:4:4", None),
+    "webp": EncoderPreset("webp", "🌐 WebP", "WEBP", 85, False, None, None),
+    "png": EncoderPreset("png", "🖼️ PNG (lossless)", "PNG", None, False, None, None),
+}
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# The JPEG decoder only picks a 1/2, 1/4 or 1/8 scale that keeps the requested
+# size, so drafts ask for a little less than the target: a 4000x3000 photo then
+# decodes at 1/2 (2000x1500) for a 2048 px target instead of at full size
+DRAFT_SLACK = 0.9
+
+
+def draft(image, width, height):
+    """Let the JPEG decoder of a freshly opened image downscale towards width x height
+
+    The decoded image is at least 90% of the target on each side; other formats
+    and images that already fit are left alone.
+    """
+    if image.format == "JPEG" and (image.width > width or image.height > height):
+        image.draft("RGB", (max(1, int(width * DRAFT_SLACK)), max(1, int(height * DRAFT_SLACK))))
+
+
+def fit_size(size, max_edge):
+    """(width, height) of size scaled down so its longest side is max_edge"""
+    ratio = max_edge / max(size)
+    return max(1, int(size[0] * ratio)), max(1, int(size[1] * ratio))
+
+
+def encode_image(image, preset):
+    """Return (bytes, mime_type) of a PIL image encoded with a preset (not "original")"""
+    if preset.max_edge and max(image.size) > preset.max_edge:
+        image = image.resize(fit_size(image.size, preset.max_edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    if preset.format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    options = {}
+    if preset.format == "JPEG":
+        options = {"quality": preset.quality, "progressive": preset.progressive}
+        if preset.subsampling:
+            options["subsampling"] = preset.subsampling
+    elif preset.format == "WEBP":
+        options = {"quality": preset.quality, "method": 4}
+    elif preset.format == "PNG":
+        options = {"compress_level": 6}
+
+    buf = io.BytesIO()
+    image.save(buf, format=preset.format, **options)
+    return buf.getvalue(), MIME_TYPES[preset.format]
+
+
+def encode_bytes(data, mime_type, preset):
+    """Return (bytes, mime_type) of an encoded photo re-encoded with a preset
+
+    The "original" preset hands the bytes back untouched.
+    """
+    if preset.format is None:
+        return data, mime_type
+    image = Image.open(io.BytesIO(data))
+    if preset.max_edge and max(image.size) > preset.max_edge:
+        # Let the JPEG decoder downscale while decoding
+        draft(image, *fit_size(image.size, preset.max_edge))
+    return encode_image(image, preset)
+
+
+def preset_with(preset, quality=None, subsampling=None):
+    """A copy of a preset with its quality and/or chroma subsampling replaced"""
+    changes = {}
+    if quality is not None and preset.quality is not None:
+        changes["quality"] = quality
+    if subsampling and preset.format == "JPEG":
+        changes["subsampling"] = subsampling
+    return preset._replace(**changes) if changes else preset
@@ -0,0 +1,212 @@
+"""Content-addressed cache for generated party photos.
+
+Results are keyed by a hash of the encoded source photo sent to the model, the
+full prompt text and the model name, so the same photo + theme never costs a second API
+call while the entry is still around. There are two tiers:
+
+* memory: a small LRU of recent results, shared by every session in the process
+* disk: one JSON manifest per key plus the raw image bytes, bounded by total
+  size and entry age
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_ORPHAN_GRACE_SECONDS = 300
+
+
+def result_key(source_digest, prompt, model):
+    """Cache key for one generation request (source_digest identifies the input photo)"""
+    hasher = hashlib.sha256()
+    for field in (model, prompt, source_digest):
+        hasher.update(field.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """Two-tier (memory LRU + disk) store of model responses.
+
+    A cached value is the list of response parts, each either
+    ``("text", str)`` or ``("image", (bytes, mime_type))``.
+    """
+
+    def __init__(self, directory, memory_bytes=128 * 1024 * 1024,
+                 disk_bytes=512 * 1024 * 1024, max_age_seconds=24 * 3600):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_age_seconds = max_age_seconds
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if directory and disk_bytes > 0:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def _disk_enabled(self):
+        return bool(self.directory) and self.disk_bytes > 0
+
+    def get(self, key):
+        """Return the cached parts for key, or None on a miss"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and time.time() - entry[0] <= self.max_age_seconds:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[1]
+            if entry is not None:
+                self._forget(key)
+
+        parts = self._read_disk(key) if self._disk_enabled else None
+        with self._lock:
+            if parts is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._remember(key, parts)
+        return parts
+
+    def put(self, key, parts):
+        """Store the response parts for key in both tiers"""
+        with self._lock:
+            self._remember(key, parts)
+        if self._disk_enabled:
+            self._write_disk(key, parts)
+            self._prune_disk()
+
+    def summary(self):
+        """Short human-readable hit/miss counters"""
+        with self._lock:
+            stats = dict(self.stats)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        return f"{hits} hits ({stats['memory_hits']} memory, {stats['disk_hits']} disk), {stats['misses']} misses"
+
+    # Memory tier (callers hold self._lock)
+
+    def _remember(self, key, parts):
+        size = _parts_size(parts)
+        if size > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._forget(key)
+        self._memory[key] = (time.time(), parts, size)
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            oldest = next(iter(self._memory))
+            self._forget(oldest)
+
+    def _forget(self, key):
+        _, _, size = self._memory.pop(key)
+        self._memory_used -= size
+
+    # Disk tier
+
+    def _manifest_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _blob_path(self, key, index):
+        return os.path.join(self.directory, f"{key}.{index}.bin")
+
+    def _read_disk(self, key):
+        manifest_path = self._manifest_path(key)
+        try:
+            if time.time() - os.path.getmtime(manifest_path) > self.max_age_seconds:
+                self._remove_disk_entry(key)
+                return None
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            parts = []
+            for index, part in enumerate(manifest["parts"]):
+                if part["kind"] == "text":
+                    parts.append(("text", part["text"]))
+                else:
+                    with open(self._blob_path(key, index), "rb") as f:
+                        parts.append(("image", (f.read(), part["mime_type"])))
+            # Touch the manifest so pruning treats it as recently used
+            os.utime(manifest_path)
+            return parts
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, parts):
+        manifest = {"created": time.time(), "parts": []}
+        try:
+            for index, (kind, value) in enumerate(parts):
+                if kind == "text":
+                    manifest["parts"].append({"kind": "text", "text": value})
+                else:
+                    data, mime_type = value
+                    _atomic_write(self._blob_path(key, index), data)
+                    manifest["parts"].append({"kind": "image", "mime_type": mime_type})
+            # The manifest is written last: its presence marks a complete entry
+            _atomic_write(self._manifest_path(key), json.dumps(manifest).encode("utf-8"))
+        except OSError:
+            self._remove_disk_entry(key)
+
+    def _remove_disk_entry(self, key):
+        for name in os.listdir(self.directory):
+            if name.startswith(f"{key}."):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def _prune_disk(self):
+        """Drop expired entries, then least recently used ones until under the size limit"""
+        entries = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            key = name.split(".", 1)[0]
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entry = entries.setdefault(key, {"size": 0, "mtime": None, "newest": 0})
+            entry["size"] += stat.st_size
+            entry["newest"] = max(entry["newest"], stat.st_mtime)
+            if name.endswith(".json"):
+                entry["mtime"] = stat.st_mtime
+
+        now = time.time()
+        total = 0
+        live = []
+        for key, entry in entries.items():
+            if entry["mtime"] is None:
+                # Blobs without a manifest are either being written right now
+                # or leftovers from an interrupted write
+                if now - entry["newest"] > _ORPHAN_GRACE_SECONDS:
+                    self._remove_disk_entry(key)
+            elif now - entry["mtime"] > self.max_age_seconds:
+                self._remove_disk_entry(key)
+            else:
+                total += entry["size"]
+                live.append((entry["mtime"], entry["size"], key))
+
+        for _, size, key in sorted(live):
+            if total <= self.disk_bytes:
+                break
+            self._remove_disk_entry(key)
+            total -= size
+
+
+def _parts_size(parts):
+    size = 0
+    for kind, value in parts:
+        size += len(value.encode("utf-8")) if kind == "text" else len(value[0])
+    return size
+
+
+def _atomic_write(path, data):
+    tmp_path = f"{path}.tmp{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,246 @@
+"""Offline stand-ins for the Gemini image model.
+
+Two flavours, both returning synthetic party photos with configurable latency,
+error rate and payload size:
+
+* StubBackend: an in-process drop-in for ``genai.Client`` (the app only uses
+  ``client.models.generate_content`` and ``client.files.upload``). Select it
+  with ``PARTY_BACKEND=stub``.
+* A local HTTP server speaking the ``models/*:generateContent`` REST call, so the
+  real SDK, serialization and connection pool are exercised too::
+
+      python stub_backend.py --port 8765 --latency 2 --error-rate 0.1
+      PARTY_GEMINI_BASE_URL=http://127.0.0.1:8765 GEMINI_API_KEY=stub streamlit run app.py
+
+Both honor the request's candidate count (each candidate is a different photo),
+up to a maximum that can be set lower to mimic a model returning fewer
+candidates than asked.
+
+Settings come from PARTY_STUB_LATENCY_S, PARTY_STUB_JITTER_S,
+PARTY_STUB_ERROR_RATE, PARTY_STUB_OUTPUT_EDGE, PARTY_STUB_FORMAT and
+PARTY_STUB_MAX_CANDIDATES (or the matching command line flags for the HTTP
+server).
+"""
+
+import argparse
+import base64
+import io
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageDraw
+from google.genai import errors, types
+
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+def synthetic_photo(edge=1024, image_format="PNG", seed=0):
+    """Encoded party-ish test image (gradient background plus confetti)"""
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient("L").resize((edge, edge))
+    image = Image.merge("RGB", (gradient, gradient.rotate(90), Image.new("L", (edge, edge), 160)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(200):
+        x, y = rng.randrange(edge), rng.randrange(edge)
+        r = rng.randrange(2, max(3, edge // 40))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buf = io.BytesIO()
+    image.save(buf, format=image_format)
+    return buf.getvalue()
+
+
+def error_payload(code):
+    """Error body in the shape the Gemini API uses (429s carry a retry hint)"""
+    status = "RESOURCE_EXHAUSTED" if code == 429 else "UNAVAILABLE"
+    error = {"code": code, "message": f"Stub {status.lower()}", "status": status}
+    if code == 429:
+        error["details"] = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "1s"}]
+    return {"error": error}
+
+
+class StubBackend:
+    """In-process drop-in for genai.Client with canned responses"""
+
+    def __init__(self, latency_s=1.0, jitter_s=0.0, error_rate=0.0, output_edge=1024,
+                 output_format="PNG", seed=None, max_candidates=8):
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.error_rate = error_rate
+        self.output_edge = output_edge
+        self.output_format = output_format.upper()
+        self.mime_type = IMAGE_MIME_TYPES[self.output_format]
+        self.max_candidates = max(1, max_candidates)
+        # Encoded once: producing the payload should not cost CPU per request
+        self.payload = synthetic_photo(output_edge, self.output_format)
+        self._payloads = [self.payload]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._file_ids = itertools.count(1)
+        self.stats = {"requests": 0, "errors": 0, "bytes_in": 0}
+        self.models = _StubModels(self)
+        self.files = _StubFiles(self)
+
+    @classmethod
+    def from_env(cls):
+        """Stub configured from PARTY_STUB_* environment variables"""
+        return cls(
+            latency_s=float(os.environ.get("PARTY_STUB_LATENCY_S", "1.0")),
+            jitter_s=float(os.environ.get("PARTY_STUB_JITTER_S", "0.0")),
+            error_rate=float(os.environ.get("PARTY_STUB_ERROR_RATE", "0.0")),
+            output_edge=int(os.environ.get("PARTY_STUB_OUTPUT_EDGE", "1024")),
+            output_format=os.environ.get("PARTY_STUB_FORMAT", "PNG"),
+            max_candidates=int(os.environ.get("PARTY_STUB_MAX_CANDIDATES", "8")),
+        )
+
+    def payloads(self, candidate_count):
+        """One encoded photo per returned candidate (each made once, then reused)"""
+        count = min(max(1, candidate_count or 1), self.max_candidates)
+        with self._lock:
+            while len(self._payloads) < count:
+                self._payloads.append(synthetic_photo(self.output_edge, self.output_format, seed=len(self._payloads)))
+            return self._payloads[:count]
+
+    def simulate(self, request_bytes=0):
+        """Sleep for one request's latency; return the error code to fail with, or None"""
+        with self._lock:
+            delay = self.latency_s + self._random.uniform(0, self.jitter_s)
+            failed = self._random.random() < self.error_rate
+            code = self._random.choice((429, 503)) if failed else None
+            self.stats["requests"] += 1
+            self.stats["bytes_in"] += request_bytes
+            if failed:
+                self.stats["errors"] += 1
+        time.sleep(delay)
+        return code
+
+
+class _StubModels:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def generate_content(self, *, model, contents, config=None):
+        request_bytes = sum(
+            len(part.inline_data.data)
+            for part in contents
+            if isinstance(part, types.Part) and part.inline_data is not None
+        )
+        code = self._backend.simulate(request_bytes)
+        if code is not None:
+            error_class = errors.ClientError if code < 500 else errors.ServerError
+            raise error_class(code, error_payload(code))
+        return types.GenerateContentResponse(
+            candidates=[
+                types.Candidate(
+                    index=index,
+                    content=types.Content(
+                        role="model",
+                        parts=[types.Part.from_bytes(data=payload, mime_type=self._backend.mime_type)],
+                    ),
+                )
+                for index, payload in enumerate(self._backend.payloads(getattr(config, "candidate_count", None)))
+            ]
+        )
+
+
+class _StubFiles:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def upload(self, *, file, config=None):
+        mime_type = getattr(config, "mime_type", None) or "application/octet-stream"
+        file_id = next(self._backend._file_ids)
+        return types.File(name=f"files/stub-{file_id}", uri=f"stub://files/stub-{file_id}", mime_type=mime_type)
+
+
+def make_http_handler(backend):
+    """Request handler class serving generateContent from a StubBackend"""
+    path_pattern = re.compile(r"^/[^/]+/models/[^/:]+:generateContent$")
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if not path_pattern.match(self.path.split("?", 1)[0]):
+                self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+                return
+            code = backend.simulate(len(body))
+            if code is not None:
+                self._send_json(code, error_payload(code))
+                return
+            try:
+                candidate_count = json.loads(body or b"{}").get("generationConfig", {}).get("candidateCount")
+            except (ValueError, AttributeError):
+                candidate_count = None
+            self._send_json(200, {
+                "candidates": [
+                    {
+                        "index": index,
+                        "finishReason": "STOP",
+                        "content": {
+                            "role": "model",
+                            "parts": [{"inlineData": {
+                                "mimeType": backend.mime_type,
+                                "data": base64.b64encode(payload).decode("ascii"),
+                            }}],
+                        },
+                    }
+                    for index, payload in enumerate(backend.payloads(candidate_count))
+                ]
+            })
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            if status == 429:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def serve_http(backend, host="127.0.0.1", port=0):
+    """Start the HTTP stub on a background thread; returns the running server"""
+    server = ThreadingHTTPServer((host, port), make_http_handler(backend))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-gemini-http", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP stand-in for the Gemini image model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with 429/503")
+    parser.add_argument("--output-edge", type=int, default=1024, help="edge of the returned image in pixels")
+    parser.add_argument("--format", default="PNG", choices=sorted(IMAGE_MIME_TYPES))
+    parser.add_argument("--max-candidates", type=int, default=8, help="most candidates returned per request")
+    args = parser.parse_args()
+
+    backend = StubBackend(args.latency, args.jitter, args.error_rate, args.output_edge, args.format,
+                          max_candidates=args.max_candidates)
+    server = serve_http(backend, args.host, args.port)
+    print(f"🍌 Stub Gemini listening on http://{args.host}:{server.server_address[1]} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
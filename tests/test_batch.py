@@ -0,0 +1,106 @@
+import json
+import os
+
+import pytest
+from PIL import Image
+
+import batch
+from batch import clean_file_name, find_photos, read_manifest
+
+
+def test_find_photos(tmp_path):
+    for name in ("b.JPG", "a.png", "notes.txt", "sub/c.webp", "sub/deeper/d.jpeg"):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+    assert find_photos(str(tmp_path), recursive=False) == ["a.png", "b.JPG"]
+    assert find_photos(str(tmp_path), recursive=True) == ["a.png", "b.JPG", "sub/c.webp", "sub/deeper/d.jpeg"]
+
+
+def test_read_manifest_keeps_done_pairs(tmp_path):
+    manifest = tmp_path / "manifest.jsonl"
+    records = [
+        {"photo": "a.jpg", "digest": "d1", "prompt": "Disco", "status": "done"},
+        {"photo": "a.jpg", "digest": "d1", "prompt": "Beach", "status": "failed"},
+        {"photo": "b.jpg", "digest": "d2", "prompt": "Disco", "status": "done"},
+    ]
+    lines = [json.dumps(record) for record in records]
+    # The last line was cut short by an interrupted run
+    manifest.write_text("\n".join(lines) + '\n{"photo": "c.jpg", "dig', encoding="utf-8")
+    assert read_manifest(str(manifest)) == {("a.jpg", "d1", "Disco", 1, None), ("b.jpg", "d2", "Disco", 1, None)}
+
+
+def test_read_manifest_without_a_file(tmp_path):
+    assert read_manifest(str(tmp_path / "manifest.jsonl")) == set()
+
+
+def test_clean_file_name():
+    assert clean_file_name("🎨 Custom: disco/70s") == "_Custom_disco_70s"
+    long_names = [clean_file_name(f"party_photo_Custom_{'winter ' * 60}{end}.png") for end in "ab"]
+    assert long_names[0] != long_names[1]
+    assert all(len(name.encode("utf-8")) <= batch.MAX_FILE_NAME_BYTES and name.endswith(".png") for name in long_names)
+
+
+@pytest.fixture
+def run_batch(tmp_path, monkeypatch):
+    """batch.main against the offline stub model, without the result cache"""
+    monkeypatch.setenv("PARTY_STUB_LATENCY_S", "0")
+    monkeypatch.setenv("PARTY_STUB_OUTPUT_EDGE", "64")
+    import app
+
+    monkeypatch.setattr(app, "BACKEND", "stub")
+    monkeypatch.setattr(app, "RESULT_CACHE_DIR", "")
+    monkeypatch.setattr(app, "RESULT_CACHE_MEMORY_MB", 0)
+
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    for name, color in (("a.jpg", "red"), ("a.png", "blue")):
+        Image.new("RGB", (64, 48), color).save(input_dir / name)
+
+    def run(*args):
+        return batch.main([str(input_dir), str(output_dir), "--themes", "", "--workers", "2", *args])
+
+    run.output_dir = output_dir
+    run.manifest = lambda: [json.loads(line) for line in (output_dir / "manifest.jsonl").read_text().splitlines()]
+    return run
+
+
+def test_photos_with_the_same_stem_keep_their_outputs(run_batch):
+    assert run_batch("--prompt", "disco") == 0
+    assert sorted(path.name for path in run_batch.output_dir.iterdir()) == ["a.jpg", "a.png", "manifest.jsonl"]
+    assert len(list((run_batch.output_dir / "a.jpg").iterdir())) == 1
+    assert len(list((run_batch.output_dir / "a.png").iterdir())) == 1
+
+
+def test_rerun_skips_done_pairs_unless_variants_or_preset_change(run_batch):
+    assert run_batch("--prompt", "disco") == 0
+    assert run_batch("--prompt", "disco") == 0
+    assert len(run_batch.manifest()) == 2
+
+    assert run_batch("--prompt", "disco", "--variants", "2") == 0
+    records = run_batch.manifest()
+    assert len(records) == 4
+    assert [len(record["outputs"]) for record in records[2:]] == [2, 2]
+
+    assert run_batch("--prompt", "disco", "--variants", "2", "--preset", "share") == 0
+    assert len(run_batch.manifest()) == 6
+    assert run_batch("--prompt", "disco", "--variants", "2", "--preset", "share") == 0
+    assert len(run_batch.manifest()) == 6
+
+
+def test_long_prompts_get_short_file_names(run_batch):
+    assert run_batch("--prompt", "a very long winter wonderland party " * 10) == 0
+    for record in run_batch.manifest():
+        assert record["status"] == "done"
+        assert all(len(os.path.basename(path).encode("utf-8")) <= 255 for path in record["outputs"])
+
+
+def test_write_errors_are_recorded_as_failures(run_batch):
+    run_batch.output_dir.mkdir()
+    # A file where a.jpg's output directory should go
+    (run_batch.output_dir / "a.jpg").write_bytes(b"")
+    assert run_batch("--prompt", "disco") == 1
+    records = {record["photo"]: record for record in run_batch.manifest()}
+    assert records["a.png"]["status"] == "done"
+    assert records["a.jpg"]["status"] == "failed"
+    assert "could not write" in records["a.jpg"]["errors"][-1]
@@ -0,0 +1,73 @@
+import gc
+import os
+import time
+
+from blob_store import BlobStore
+
+
+def test_put_get_delete(tmp_path):
+    store = BlobStore(spill_dir=str(tmp_path))
+    blob_id = store.put("s1", b"photo")
+    assert store.get(blob_id) == b"photo"
+    assert store.session_of(blob_id) == "s1"
+    store.delete(blob_id)
+    assert blob_id not in store
+    assert store.get(blob_id) is None
+
+
+def test_spills_least_recently_used_blobs_to_disk(tmp_path):
+    store = BlobStore(memory_bytes=250, spill_dir=str(tmp_path))
+    first = store.put("s1", b"a" * 100)
+    second = store.put("s1", b"b" * 100)
+    store.get(first)
+    third = store.put("s1", b"c" * 100)
+    assert store.stats["spilled"] == 1
+    assert os.listdir(store.spill_dir) == [second]
+    assert [store.get(b) for b in (first, second, third)] == [b"a" * 100, b"b" * 100, b"c" * 100]
+
+
+def test_session_quota_evicts_that_sessions_oldest_blobs(tmp_path):
+    store = BlobStore(session_quota=250, spill_dir=str(tmp_path))
+    other = store.put("s2", b"z" * 200)
+    first = store.put("s1", b"a" * 100)
+    second = store.put("s1", b"b" * 100)
+    third = store.put("s1", b"c" * 100)
+    assert first not in store
+    assert second in store and third in store
+    assert other in store
+    assert store.stats["evicted"] == 1
+
+
+def test_global_quota_and_oversized_blobs(tmp_path):
+    store = BlobStore(session_quota=1000, global_quota=250, spill_dir=str(tmp_path))
+    first = store.put("s1", b"a" * 100)
+    second = store.put("s2", b"b" * 100)
+    third = store.put("s3", b"c" * 100)
+    assert first not in store
+    assert second in store and third in store
+    # The newest blob is kept even when it alone is over the quota
+    big = store.put("s4", b"d" * 500)
+    assert store.get(big) == b"d" * 500
+    assert second not in store and third not in store
+
+
+def test_session_blobs_go_away_with_the_handle(tmp_path):
+    store = BlobStore(memory_bytes=50, spill_dir=str(tmp_path))
+    session = store.open_session("s1")
+    blob_ids = [session.put(b"x" * 40) for _ in range(3)]
+    kept = store.put("s2", b"y")
+    assert os.listdir(store.spill_dir)
+    del session
+    gc.collect()
+    assert not any(blob_id in store for blob_id in blob_ids)
+    assert kept in store
+    assert os.listdir(store.spill_dir) == []
+
+
+def test_idle_sessions_are_dropped(tmp_path):
+    store = BlobStore(idle_ttl_seconds=0.05, spill_dir=str(tmp_path))
+    idle = store.put("s1", b"photo")
+    time.sleep(0.1)
+    active = store.put("s2", b"photo")
+    assert idle not in store
+    assert active in store
@@ -0,0 +1,54 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+import chroma_key
+
+
+def green_screen_photo(size=(1024, 768), screen=(40, 190, 70), shadow=False):
+    image = Image.new("RGB", size, screen)
+    draw = ImageDraw.Draw(image)
+    if shadow:
+        # A dark band across half of the screen
+        draw.rectangle((0, 0, size[0] // 2, size[1]), fill=tuple(c // 3 for c in screen))
+    # The "person": a skin-toned block in the middle
+    draw.rectangle((size[0] // 3, size[1] // 4, 2 * size[0] // 3, size[1]), fill=(210, 160, 130))
+    return image
+
+
+def test_clean_green_screen_scores_high():
+    result = chroma_key.analyze(green_screen_photo())
+    assert result.score >= 90
+    assert result.issues == []
+    assert 0.5 < result.coverage < 0.9
+    assert result.key_color[1] > result.key_color[0]
+    assert result.alpha.shape == (384, 512)
+    assert result.alpha.min() >= 0.0 and result.alpha.max() <= 1.0
+
+
+def test_uneven_screen_scores_lower():
+    clean = chroma_key.analyze(green_screen_photo())
+    shadowed = chroma_key.analyze(green_screen_photo(shadow=True))
+    assert shadowed.score < clean.score
+    assert any("unevenly lit" in issue for issue in shadowed.issues)
+
+
+def test_no_green_screen():
+    photo = Image.new("RGB", (300, 200), (120, 110, 200))
+    result = chroma_key.analyze(photo)
+    assert (result.score, result.key_color) == (0, None)
+    assert np.all(result.alpha == 1.0)
+    assert chroma_key.prekey(photo) is None
+
+
+def test_prekey_puts_the_person_on_flat_green():
+    photo = green_screen_photo(shadow=True)
+    keyed = chroma_key.prekey(photo, chroma_key.analyze(photo).key_color)
+    assert keyed.size == photo.size
+    assert keyed.getpixel((10, 10)) == chroma_key.FLAT_GREEN
+    assert keyed.getpixel((512, 500)) == (210, 160, 130)
+    assert chroma_key.prekey(photo).getpixel((10, 10)) == chroma_key.FLAT_GREEN
+
+
+def test_preview_matches_the_analyzed_size():
+    photo = green_screen_photo()
+    assert chroma_key.preview(photo, chroma_key.analyze(photo)).size == (512, 384)
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+from google.genai import errors
+
+from governor import RequestGovernor, retry_hint_seconds
+
+
+def api_error(code, retry_delay=None):
+    error = {"code": code, "message": "test", "status": "TEST"}
+    if retry_delay is not None:
+        error["details"] = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": retry_delay}]
+    cls = errors.ClientError if code < 500 else errors.ServerError
+    return cls(code, {"error": error})
+
+
+def failing(*excs, result="ok"):
+    """request() raising each exception in turn, then returning result"""
+    pending = list(excs)
+
+    def request():
+        if pending:
+            raise pending.pop(0)
+        return result
+    return request
+
+
+def test_zero_requests_per_minute_means_no_rate_limit():
+    governor = RequestGovernor(requests_per_minute=0, max_concurrency=2)
+    started = time.monotonic()
+    assert [governor.call(lambda: n) for n in range(20)] == list(range(20))
+    assert time.monotonic() - started < 1.0
+    assert governor.stats["requests"] == 20
+
+
+def test_rate_limit_spaces_requests():
+    # A bucket of one token refilled every 0.1 s
+    governor = RequestGovernor(requests_per_minute=600, max_concurrency=1)
+    started = time.monotonic()
+    for _ in range(3):
+        governor.call(lambda: None)
+    assert time.monotonic() - started >= 0.18
+
+
+def test_concurrency_cap():
+    governor = RequestGovernor(requests_per_minute=0, max_concurrency=2)
+    peak, lock = [0], threading.Lock()
+
+    def request():
+        with lock:
+            peak[0] = max(peak[0], governor.in_flight)
+        time.sleep(0.02)
+
+    threads = [threading.Thread(target=governor.call, args=(request,)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+    assert governor.in_flight == 0
+
+
+def test_retries_transient_errors():
+    governor = RequestGovernor(requests_per_minute=0, base_delay=0.001, max_retries=3)
+    retries = []
+    result = governor.call(failing(api_error(503), api_error(500)), on_retry=lambda *args: retries.append(args[0]))
+    assert result == "ok"
+    assert retries == [1, 2]
+    assert governor.stats["retries"] == 2
+
+
+def test_gives_up_after_max_retries():
+    governor = RequestGovernor(requests_per_minute=0, base_delay=0.001, max_retries=1)
+    with pytest.raises(errors.ServerError):
+        governor.call(failing(api_error(503), api_error(503)))
+    assert governor.stats["failures"] == 1
+
+
+def test_does_not_retry_client_errors():
+    governor = RequestGovernor(requests_per_minute=0, base_delay=0.001)
+    with pytest.raises(errors.ClientError):
+        governor.call(failing(api_error(400)))
+    assert governor.stats["retries"] == 0
+
+
+def test_throttling_halves_the_concurrency_limit():
+    governor = RequestGovernor(requests_per_minute=0, max_concurrency=8, base_delay=0.001)
+    governor.call(failing(api_error(429)))
+    assert governor.concurrency_limit == 4
+    assert governor.stats["throttled"] == 1
+
+
+def test_retry_hint_from_retry_info():
+    assert retry_hint_seconds(api_error(429, retry_delay="3s")) == 3.0
+    assert retry_hint_seconds(api_error(429)) is None
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from job_queue import JobQueue
+
+PROMPTS = [("Disco", "a disco party"), ("Beach", "a beach party")]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path), lease_seconds=600)
+
+
+def photo(prompt_name, data=b"photo"):
+    return {"data": data, "mime_type": "image/png", "file_name": f"{prompt_name}.png", "prompt_name": prompt_name}
+
+
+def expire_leases(queue):
+    with queue._transaction() as db:
+        db.execute("UPDATE tasks SET leased_until = leased_until - ?", (queue.lease_seconds + 1,))
+
+
+def age_job(queue, job_id, seconds):
+    with queue._transaction() as db:
+        db.execute("UPDATE jobs SET updated = updated - ? WHERE id = ?", (seconds, job_id))
+
+
+def test_submitting_the_same_work_finds_the_same_job(queue):
+    job_id = queue.submit(b"source", "image/jpeg", PROMPTS, "model")
+    assert queue.submit(b"source", "image/jpeg", PROMPTS, "model") == job_id
+    assert queue.submit(b"source", "image/jpeg", PROMPTS, "other-model") != job_id
+    assert queue.submit(b"source", "image/jpeg", PROMPTS, "model", variants=2) != job_id
+    assert queue.status(job_id)["total"] == 2
+
+
+def test_claim_complete_and_read_back(queue):
+    job_id = queue.submit(b"source", "image/jpeg", PROMPTS, "model", session="s1")
+    first, second = queue.claim("w1"), queue.claim("w2")
+    assert (first["index"], second["index"]) == (0, 1)
+    assert first["prompt_name"] == "Disco"
+    assert first["session"] == "s1"
+    assert queue.read_source(first) == b"source"
+    assert queue.claim("w3") is None
+
+    queue.complete(first, [photo("Disco")], [("success", "done")])
+    status = queue.status(job_id)
+    assert (status["done"], status["finished"]) == (1, False)
+
+    queue.complete(second, [], [("error", "no photo")])
+    status = queue.status(job_id)
+    assert (status["done"], status["failed"], status["finished"]) == (1, 1, True)
+
+    photos, messages = queue.results(job_id, 0)
+    assert photos == [photo("Disco")]
+    assert messages == [("success", "done")]
+    assert queue.results(job_id, 1) == ([], [("error", "no photo")])
+
+
+def test_expired_lease_is_claimed_again(queue):
+    queue.submit(b"source", "image/jpeg", PROMPTS[:1], "model")
+    task = queue.claim("dead-worker")
+    assert queue.claim("w2") is None
+    expire_leases(queue)
+    retried = queue.claim("w2")
+    assert (retried["job_id"], retried["index"]) == (task["job_id"], task["index"])
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path), lease_seconds=600, max_attempts=2)
+    job_id = queue.submit(b"source", "image/jpeg", PROMPTS[:1], "model")
+    for _ in range(2):
+        assert queue.claim("dying-worker") is not None
+        expire_leases(queue)
+    assert queue.claim("w") is None
+    status = queue.status(job_id)
+    assert (status["failed"], status["finished"]) == (1, True)
+    assert "Gave up" in queue.results(job_id, 0)[1][0][1]
+
+
+def test_resubmitting_requeues_failed_prompts(queue):
+    job_id = queue.submit(b"source", "image/jpeg", PROMPTS, "model")
+    first, second = queue.claim("w"), queue.claim("w")
+    queue.complete(first, [photo("Disco")], [])
+    queue.complete(second, [], [("error", "boom")])
+
+    assert queue.submit(b"source", "image/jpeg", PROMPTS, "model") == job_id
+    retried = queue.claim("w")
+    assert retried["index"] == 1
+    assert queue.claim("w") is None
+    assert queue.status(job_id)["finished"] is False
+
+
+def test_late_completion_does_not_overwrite_a_done_task(queue):
+    job_id = queue.submit(b"source", "image/jpeg", PROMPTS[:1], "model")
+    task = queue.claim("slow-worker")
+    expire_leases(queue)
+    queue.complete(queue.claim("w2"), [photo("Disco", b"new")], [])
+    queue.complete(task, [], [("error", "timed out")])
+    assert queue.status(job_id)["done"] == 1
+    assert queue.results(job_id, 0)[0][0]["data"] == b"new"
+
+
+def test_prune_removes_old_jobs_and_their_files(tmp_path):
+    queue = JobQueue(str(tmp_path), lease_seconds=600, max_age_seconds=3600)
+    old = queue.submit(b"old source", "image/jpeg", PROMPTS[:1], "model")
+    queue.complete(queue.claim("w"), [photo("Disco")], [])
+    fresh = queue.submit(b"new source", "image/jpeg", PROMPTS[:1], "model")
+    age_job(queue, old, 7200)
+    # Sources younger than the prune interval may belong to a job being submitted
+    sources = os.path.join(queue.directory, "sources")
+    for name in os.listdir(sources):
+        os.utime(os.path.join(sources, name), (time.time() - 7200,) * 2)
+
+    queue._pruned_at = 0.0
+    queue._maybe_prune()
+    assert queue.status(old) is None
+    assert queue.status(fresh) is not None
+    assert not os.path.exists(os.path.join(queue.directory, "results", old))
+    assert os.listdir(sources) == [f"{hashlib.sha256(b'new source').hexdigest()}.bin"]
+
+
+def test_workers_run_submitted_jobs(queue):
+    handled = []
+
+    def handler(task):
+        handled.append(task["session"])
+        return [photo(task["prompt_name"])], []
+
+    queue.start_workers(handler, 2, poll_seconds=0.05)
+    job_id = queue.submit(b"source", "image/jpeg", PROMPTS, "model", session="s1")
+    deadline = time.time() + 10
+    while not queue.status(job_id)["finished"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert queue.status(job_id)["done"] == 2
+    assert handled == ["s1", "s1"]
+
+
+def test_renew_extends_only_the_workers_own_lease(queue):
+    queue.submit(b"source", "image/jpeg", PROMPTS[:1], "model")
+    task = queue.claim("w1")
+    expire_leases(queue)
+    assert queue.renew(task, "w1")
+    assert queue.claim("w2") is None
+    assert not queue.renew(task, "w2")
+    queue.complete(task, [photo("Disco")], [])
+    assert not queue.renew(task, "w1")
+
+
+def test_workers_keep_a_long_task_leased(tmp_path):
+    queue = JobQueue(str(tmp_path), lease_seconds=0.3)
+    handled = []
+
+    def handler(task):
+        handled.append(task["index"])
+        # Several lease periods
+        time.sleep(1.2)
+        return [photo(task["prompt_name"])], []
+
+    queue.start_workers(handler, 2, poll_seconds=0.05)
+    job_id = queue.submit(b"source", "image/jpeg", PROMPTS[:1], "model")
+    deadline = time.time() + 10
+    while not queue.status(job_id)["finished"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert queue.status(job_id)["done"] == 1
+    assert handled == [0]
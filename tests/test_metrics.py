@@ -0,0 +1,78 @@
+import json
+import threading
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def recording(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "_samples", {})
+    monkeypatch.setattr(metrics, "_totals", {})
+    monkeypatch.setattr(metrics, "_gauges", {})
+    monkeypatch.setattr(metrics, "PROM_FILE", None)
+    monkeypatch.setattr(metrics, "LOG_PATH", None)
+    monkeypatch.setattr(metrics, "_log_file", None)
+
+
+def test_disabled_recording_is_a_no_op(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", False)
+    monkeypatch.setattr(metrics, "_samples", {})
+    with metrics.timer("stage"):
+        pass
+    metrics.record("stage", 1.0)
+    assert metrics.summary() == {}
+
+
+def test_summary_quantiles(recording):
+    for ms in range(1, 101):
+        metrics.record("decode", ms / 1000)
+    with metrics.timer("encode"):
+        pass
+    summary = metrics.summary()
+    assert summary["decode"] == {"count": 100, "p50": 0.051, "p95": 0.096}
+    assert summary["encode"]["count"] == 1
+
+
+def test_rolling_window_keeps_the_count(recording, monkeypatch):
+    monkeypatch.setattr(metrics, "WINDOW", 10)
+    for value in range(20):
+        metrics.record("stage", float(value))
+    summary = metrics.summary()["stage"]
+    assert summary["count"] == 20
+    assert summary["p50"] == 15.0
+
+
+def test_prometheus_text(recording):
+    metrics.record("zip_encode", 0.25)
+    metrics.record("zip_encode", 0.75)
+    metrics.gauge_add("in_flight_requests", 2)
+    metrics.gauge_add("in_flight_requests", -1)
+    lines = metrics.prometheus_text().splitlines()
+    assert '# TYPE party_stage_seconds summary' in lines
+    assert 'party_stage_seconds{stage="zip_encode",quantile="0.5"} 0.750000' in lines
+    assert 'party_stage_seconds_sum{stage="zip_encode"} 1.000000' in lines
+    assert 'party_stage_seconds_count{stage="zip_encode"} 2' in lines
+    assert "party_in_flight_requests 1" in lines
+
+
+def test_tags_are_per_thread_and_nest(recording, monkeypatch, tmp_path):
+    log_path = tmp_path / "metrics.jsonl"
+    monkeypatch.setattr(metrics, "LOG_PATH", str(log_path))
+    metrics.set_tags(session="s1")
+    with metrics.tags(prompt="Disco"):
+        metrics.record("model_latency", 0.1)
+        other = threading.Thread(target=metrics.record, args=("model_latency", 0.2))
+        other.start()
+        other.join()
+    metrics.record("model_latency", 0.3, prompt="Beach")
+    assert metrics.current_tags() == {"session": "s1"}
+    metrics.set_tags()
+    metrics._log_file.close()
+
+    entries = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert [(entry.get("session"), entry.get("prompt")) for entry in entries] == [
+        ("s1", "Disco"), (None, None), ("s1", "Beach"),
+    ]
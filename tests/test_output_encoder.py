@@ -0,0 +1,77 @@
+import io
+
+from PIL import Image
+
+from output_encoder import PRESETS, draft, encode_bytes, encode_image, fit_size, preset_with
+
+
+def photo(size=(640, 480), mode="RGB", image_format="PNG"):
+    image = Image.new(mode, size, (200, 40, 120) if mode == "RGB" else None)
+    buf = io.BytesIO()
+    image.save(buf, format=image_format)
+    return buf.getvalue()
+
+
+def test_original_passes_bytes_through():
+    data = photo()
+    assert encode_bytes(data, "image/png", PRESETS["original"]) == (data, "image/png")
+
+
+def test_share_is_a_downscaled_jpeg():
+    data, mime_type = encode_bytes(photo((4096, 3072), image_format="JPEG"), "image/jpeg", PRESETS["share"])
+    image = Image.open(io.BytesIO(data))
+    assert mime_type == "image/jpeg"
+    assert (image.format, image.size) == ("JPEG", (2048, 1536))
+
+
+def test_share_takes_the_half_scale_draft_for_camera_sizes():
+    # 4000 px is less than twice the 2048 px limit: decoded at 1/2, not resized up
+    data, _ = encode_bytes(photo((4000, 3000), image_format="JPEG"), "image/jpeg", PRESETS["share"])
+    assert Image.open(io.BytesIO(data)).size == (2000, 1500)
+
+
+def test_draft_picks_the_largest_reduction_within_the_slack():
+    jpeg = photo((4000, 3000), image_format="JPEG")
+    for target, decoded in (((2048, 1536), (2000, 1500)), ((500, 375), (500, 375)), ((1000, 750), (1000, 750)),
+                            ((3900, 2925), (4000, 3000))):
+        image = Image.open(io.BytesIO(jpeg))
+        draft(image, *target)
+        assert image.size == decoded
+    image = Image.open(io.BytesIO(photo((4000, 3000))))
+    draft(image, 500, 375)
+    assert image.size == (4000, 3000)
+
+
+def test_fit_size():
+    assert fit_size((4000, 3000), 2048) == (2048, 1536)
+    assert fit_size((3000, 4000), 1000) == (750, 1000)
+
+
+def test_small_photos_are_not_upscaled():
+    data, _ = encode_bytes(photo((640, 480)), "image/png", PRESETS["share"])
+    assert Image.open(io.BytesIO(data)).size == (640, 480)
+
+
+def test_formats_and_mime_types():
+    for name, image_format, mime_type in (("archive", "JPEG", "image/jpeg"), ("webp", "WEBP", "image/webp"),
+                                          ("png", "PNG", "image/png")):
+        data, mime = encode_bytes(photo((300, 200)), "image/png", PRESETS[name])
+        image = Image.open(io.BytesIO(data))
+        assert (mime, image.format, image.size) == (mime_type, image_format, (300, 200))
+
+
+def test_transparent_photos_become_rgb_jpegs():
+    image = Image.new("RGBA", (64, 64), (0, 255, 0, 0))
+    data, _ = encode_image(image, PRESETS["archive"])
+    assert Image.open(io.BytesIO(data)).mode == "RGB"
+    data, _ = encode_image(image, PRESETS["png"])
+    assert Image.open(io.BytesIO(data)).mode == "RGBA"
+
+
+def test_preset_with_overrides_only_what_applies():
+    share = PRESETS["share"]
+    assert preset_with(share) is share
+    assert preset_with(share, quality=70, subsampling="4:4:4")[3:6] == (70, True, "4:4:4")
+    assert preset_with(PRESETS["webp"], subsampling="4:4:4") is PRESETS["webp"]
+    assert preset_with(PRESETS["png"], quality=70) is PRESETS["png"]
+    assert preset_with(PRESETS["original"], quality=70) is PRESETS["original"]
@@ -0,0 +1,89 @@
+import os
+import time
+
+from result_cache import ResultCache, result_key
+
+
+def parts(data=b"x" * 100, text="caption"):
+    return [("text", text), ("image", (data, "image/png"))]
+
+
+def age(directory, key, seconds):
+    for name in os.listdir(directory):
+        if name.startswith(f"{key}."):
+            path = os.path.join(directory, name)
+            os.utime(path, (time.time() - seconds,) * 2)
+
+
+def test_result_key_covers_every_field():
+    key = result_key("digest", "prompt", "model")
+    assert key == result_key("digest", "prompt", "model")
+    assert len({key, result_key("other", "prompt", "model"), result_key("digest", "other", "model"),
+                result_key("digest", "prompt", "other")}) == 4
+
+
+def test_memory_tier_hit_and_lru_eviction():
+    cache = ResultCache(None, memory_bytes=250)
+    cache.put("a", parts())
+    cache.put("b", parts())
+    assert cache.get("a") == parts()
+    # "b" is now the least recently used one
+    cache.put("c", parts())
+    assert cache.get("b") is None
+    assert cache.get("a") == parts()
+    assert cache.stats == {"memory_hits": 2, "disk_hits": 0, "misses": 1}
+
+
+def test_too_large_for_memory_is_not_kept():
+    cache = ResultCache(None, memory_bytes=10)
+    cache.put("a", parts())
+    assert cache.get("a") is None
+
+
+def test_disk_tier_survives_a_new_process(tmp_path):
+    ResultCache(str(tmp_path)).put("a", parts())
+    cache = ResultCache(str(tmp_path))
+    assert cache.get("a") == parts()
+    assert cache.get("a") == parts()
+    assert cache.stats == {"memory_hits": 1, "disk_hits": 1, "misses": 0}
+
+
+def test_expired_entries_are_misses(tmp_path):
+    ResultCache(str(tmp_path), max_age_seconds=60).put("a", parts())
+    age(str(tmp_path), "a", 120)
+    cache = ResultCache(str(tmp_path), max_age_seconds=60)
+    assert cache.get("a") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_disk_prune_drops_least_recently_used_entries(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_bytes=0)
+    cache.put("a", parts())
+    # Room for two entries, not three
+    entry_size = sum(os.path.getsize(os.path.join(tmp_path, name)) for name in os.listdir(tmp_path))
+    cache.disk_bytes = entry_size * 5 // 2
+    cache.put("b", parts())
+    age(str(tmp_path), "a", 30)
+    age(str(tmp_path), "b", 20)
+    # Reading "a" marks it as recently used, so "b" goes first
+    assert cache.get("a") == parts()
+    cache.put("c", parts())
+    assert ResultCache(str(tmp_path)).get("b") is None
+    assert ResultCache(str(tmp_path)).get("a") == parts()
+    assert ResultCache(str(tmp_path)).get("c") == parts()
+
+
+def test_disk_prune_drops_expired_entries_and_orphaned_blobs(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_bytes=0, max_age_seconds=60)
+    cache.put("old", parts())
+    age(str(tmp_path), "old", 120)
+    # Image bytes from a write that never got its manifest
+    (tmp_path / "orphan.1.bin").write_bytes(b"x")
+    age(str(tmp_path), "orphan", 3600)
+    cache.put("new", parts())
+    assert sorted(os.listdir(tmp_path)) == ["new.1.bin", "new.json"]
+
+
+def test_corrupt_manifest_is_a_miss(tmp_path):
+    (tmp_path / "a.json").write_text("{not json")
+    assert ResultCache(str(tmp_path)).get("a") is None
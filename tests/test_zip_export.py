@@ -0,0 +1,54 @@
+import io
+import zipfile
+
+import pytest
+
+from zip_export import ZipExport
+
+
+def test_builds_a_stored_archive():
+    export = ZipExport()
+    assert export.add("a.png", b"first") == "a.png"
+    assert export.add("b.jpg", b"second") == "b.jpg"
+    archive = zipfile.ZipFile(io.BytesIO(export.finish().read()))
+    assert archive.namelist() == ["a.png", "b.jpg"]
+    assert archive.read("b.jpg") == b"second"
+    assert {info.compress_type for info in archive.infolist()} == {zipfile.ZIP_STORED}
+    assert export.count == 2
+    assert export.size == len(export.read())
+
+
+def test_duplicate_names_get_a_suffix():
+    export = ZipExport()
+    names = [export.add("party.png", bytes([i])) for i in range(3)]
+    assert names == ["party.png", "party_2.png", "party_3.png"]
+    assert export.add("party_2.png", b"x") == "party_2_2.png"
+    assert len(zipfile.ZipFile(io.BytesIO(export.finish().read())).namelist()) == 4
+
+
+def test_spilled_archive_reads_back():
+    export = ZipExport(spool_bytes=10)
+    export.add("big.png", b"x" * 1000)
+    assert zipfile.ZipFile(io.BytesIO(export.finish().read())).read("big.png") == b"x" * 1000
+
+
+def test_read_before_finish_and_add_after_finish():
+    export = ZipExport()
+    export.add("a.png", b"a")
+    with pytest.raises(ValueError):
+        export.read()
+    export.finish()
+    with pytest.raises(ValueError):
+        export.add("b.png", b"b")
+    # finish is idempotent
+    assert export.finish().count == 1
+
+
+def test_close_releases_the_file():
+    export = ZipExport()
+    export.add("a.png", b"a")
+    export.close()
+    assert export.finished
+    with pytest.raises(ValueError):
+        export.read()
+    ZipExport().finish().close()
@@ -0,0 +1,41 @@
+"""Standalone worker for the party photo job queue.
+
+Runs queued prompts outside the Streamlit processes, so generation throughput
+grows with the number of workers rather than with the number of browser
+sessions. Use the same settings (PARTY_JOB_DIR, GEMINI_API_KEY, PARTY_* limits)
+as the app::
+
+    PARTY_JOB_WORKERS=0 streamlit run app.py     # the app only queues jobs
+    python worker.py --workers 8                 # one or more worker processes
+
+Note that each process has its own request governor, so PARTY_REQUESTS_PER_MINUTE
+applies per process.
+"""
+
+import argparse
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued party photo prompts")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker threads (default: PARTY_JOB_WORKERS, or PARTY_GEMINI_POOL_SIZE)")
+    args = parser.parse_args()
+
+    import app
+
+    count = args.workers if args.workers is not None else max(1, app.JOB_WORKERS)
+    queue = app.get_job_queue()
+    app.start_job_workers(queue, count)
+    print(f"🍌 {count} workers serving jobs in {queue.directory} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
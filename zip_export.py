@@ -0,0 +1,79 @@
+"""Incremental ZIP export of a party photo gallery.
+
+Photos are appended to the archive as soon as they are generated, so pressing
+"Download All" only has to serve bytes that already exist. Entries use
+ZIP_STORED because the photos are already compressed (JPEG/PNG/WebP), and the
+archive lives in a spooled temp file that moves to disk once it grows past
+``spool_bytes``.
+"""
+
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+
+class ZipExport:
+    """A ZIP archive built one photo at a time"""
+
+    def __init__(self, spool_bytes=32 * 1024 * 1024):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self._zip = zipfile.ZipFile(self._file, "w", zipfile.ZIP_STORED)
+        self._names = set()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.count = 0
+        self.finished = False
+
+    def add(self, file_name, data):
+        """Append one photo to the archive and return the name it was stored under"""
+        with self._lock:
+            if self.finished:
+                raise ValueError("Cannot add photos to a finished ZIP export")
+            name = self._unique_name(file_name)
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            self._zip.writestr(info, data)
+            self.count += 1
+            return name
+
+    def finish(self):
+        """Write the central directory; after this the archive is ready to serve"""
+        with self._lock:
+            if not self.finished:
+                self._zip.close()
+                self._size = self._file.tell()
+                self.finished = True
+        return self
+
+    @property
+    def size(self):
+        """Size of the finished archive in bytes"""
+        return self._size
+
+    def read(self):
+        """Bytes of the finished archive"""
+        with self._lock:
+            if not self.finished:
+                raise ValueError("ZIP export is not finished yet")
+            self._file.seek(0)
+            return self._file.read()
+
+    def close(self):
+        """Release the underlying buffer or temp file"""
+        with self._lock:
+            if not self.finished:
+                self._zip.close()
+                self.finished = True
+            self._file.close()
+
+    def _unique_name(self, file_name):
+        stem, ext = os.path.splitext(file_name)
+        name = file_name
+        suffix = 2
+        while name in self._names:
+            name = f"{stem}_{suffix}{ext}"
+            suffix += 1
+        self._names.add(name)
+        return name